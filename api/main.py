@@ -1,12 +1,23 @@
+import asyncio
+import base64
+import binascii
+from contextlib import asynccontextmanager
+from functools import lru_cache
 from fastapi import FastAPI, Query, Request, Response
 from fastapi import HTTPException
-from typing import List, Dict, Any, Optional
-from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from typing import AsyncIterator, List, Dict, Any, Optional, Tuple
 import math
 import os
-import httpx
-from opensearchpy import OpenSearch
+import re
+import time
+from opensearchpy import AsyncOpenSearch
+from opensearchpy.exceptions import SerializationError
+from opensearchpy.serializer import JSONSerializer
 import logging
+import logging.handlers
+import queue
+import orjson
 
 # optionally load a local .env file for development; secrets should not be committed
 from dotenv import load_dotenv
@@ -14,14 +25,41 @@ load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), '.env'), overrid
 
 # Import running cost calculation
 from running_cost import calculate_running_cost
+from middleware import CORSHeadersASGI
 
 
 # We return upstream EPC data as-is; do not rename or map fields.
 
-logging.basicConfig(
-    level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s"
-)
 logger = logging.getLogger("green-home-search.api")
+logger.setLevel(logging.INFO)
+
+_LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+
+class _FallbackLogHandler(logging.StreamHandler):
+    """Write to stderr only while the root logger has no handlers.
+
+    Keeps INFO output from imports, scripts and tests that use this module
+    outside the app's lifespan, without doubling lines once something else
+    has configured logging (records always propagate to the root logger).
+    """
+
+    def emit(self, record: logging.LogRecord) -> None:
+        if not logging.getLogger().handlers:
+            super().emit(record)
+
+
+_log_fallback_handler = _FallbackLogHandler()
+_log_fallback_handler.setFormatter(logging.Formatter(_LOG_FORMAT))
+logger.addHandler(_log_fallback_handler)
+
+# While the app is running, log records are queued by request handlers and
+# written by a background listener thread, so logging never blocks the event
+# loop on I/O (see lifespan). Records still propagate to the root logger.
+_log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+_log_queue_handler = logging.handlers.QueueHandler(_log_queue)
+_log_stream_handler = logging.StreamHandler()
+_log_stream_handler.setFormatter(logging.Formatter(_LOG_FORMAT))
 
 # OpenSearch configuration
 OPENSEARCH_URL = os.environ.get("OPENSEARCH_URL", "http://localhost:9200")
@@ -30,28 +68,85 @@ OPENSEARCH_PASS = os.environ.get("OPENSEARCH_PASS", "admin")
 CERTIFICATES_INDEX = os.environ.get("CERTIFICATES_INDEX", "certificates")
 PROPERTIES_INDEX = os.environ.get("PROPERTIES_INDEX", "properties")
 LISTINGS_SEARCH_ALIAS = os.environ.get("LISTINGS_SEARCH_ALIAS", "listings-active")
-
-# Initialize OpenSearch client
-opensearch_client = OpenSearch(
+# Max open connections to OpenSearch per worker (the client default of 10 caps concurrent queries)
+OPENSEARCH_POOL_MAXSIZE = int(os.environ.get("OPENSEARCH_POOL_MAXSIZE", "64"))
+# Full UK postcode without the space: 1-2 letters, 1-2 digits, optional letter, digit, 2 letters
+_FULL_POSTCODE_RE = re.compile(r'^[A-Z]{1,2}\d{1,2}[A-Z]?\d[A-Z]{2}$')
+# Hits are counted exactly up to this many; beyond it totals are reported as a lower bound
+TOTAL_HITS_TRACK_LIMIT = 10000
+# Seconds a successful /health response is reused, so frequent probes don't hit OpenSearch
+HEALTH_CACHE_TTL = float(os.environ.get("HEALTH_CACHE_TTL", "2.0"))
+
+class ORJSONSerializer(JSONSerializer):
+    """opensearch-py serializer using orjson to encode request bodies and parse responses."""
+
+    def dumps(self, data: Any) -> Any:
+        # don't serialize strings (pre-encoded bodies)
+        if isinstance(data, str):
+            return data
+        try:
+            return orjson.dumps(data, default=self.default).decode("utf-8")
+        except TypeError as e:
+            raise SerializationError(data, e)
+
+    def loads(self, s: Any) -> Any:
+        try:
+            return orjson.loads(s)
+        except orjson.JSONDecodeError as e:
+            raise SerializationError(s, e)
+
+
+# Initialize OpenSearch client (async, so queries don't block the event loop)
+# One client (and connection pool) per process, shared by all requests
+opensearch_client = AsyncOpenSearch(
     hosts=[OPENSEARCH_URL],
+    serializer=ORJSONSerializer(),
     http_auth=(OPENSEARCH_USER, OPENSEARCH_PASS) if OPENSEARCH_USER and OPENSEARCH_PASS else None,
     use_ssl=False,
     verify_certs=False,
     ssl_assert_hostname=False,
-    ssl_show_warn=False
+    ssl_show_warn=False,
+    maxsize=OPENSEARCH_POOL_MAXSIZE,
+    # gzip request bodies and ask OpenSearch to gzip responses
+    http_compress=True,
+    timeout=30,
+    retry_on_timeout=True,
+    max_retries=2,
 )
 
-app = FastAPI(title="Green Home Search API")
 
-# Allow calls from the Vite dev server and local clients
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["http://localhost:5173", "http://127.0.0.1:5173", "http://localhost:3000", "*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Only write our own log output when nothing has configured the root
+    # logger; otherwise propagation already hands records to its handlers.
+    # The queue replaces the synchronous fallback handler while serving.
+    log_listener = None
+    if not logging.getLogger().handlers:
+        log_listener = logging.handlers.QueueListener(_log_queue, _log_stream_handler)
+        log_listener.start()
+        logger.removeHandler(_log_fallback_handler)
+        logger.addHandler(_log_queue_handler)
+    try:
+        yield
+    finally:
+        if log_listener is not None:
+            logger.removeHandler(_log_queue_handler)
+            log_listener.stop()
+            logger.addHandler(_log_fallback_handler)
+        # The OpenSearch client (and its connection pool) is shared by every
+        # request; release the pooled connections when the app shuts down.
+        await opensearch_client.close()
+
+
+app = FastAPI(
+    title="Green Home Search API",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
 )
 
+# Allow calls from the Vite dev server and local clients (any origin, no credentials)
+app.add_middleware(CORSHeadersASGI)
+
 @app.get("/", summary="API root")
 async def root():
     return {"status": "ok", "message": "Green Home Search API - see /docs"}
@@ -86,17 +181,58 @@ async def get_running_cost(epc_document: Dict[str, Any]):
     return {"running_cost": cost}
 
 
+@app.post("/running-cost/batch", summary="Calculate running costs for several EPC documents")
+async def get_running_costs(epc_documents: List[Dict[str, Any]]):
+    """
+    Calculate monthly running costs for a list of EPC documents in one request.
+    
+    Parameters:
+    - epc_documents: A list of EPC documents, each as accepted by `/running-cost`
+    
+    Returns:
+    - running_costs: Monthly running costs in GBP, in request order (null where a document has no cost data)
+    
+    Example request body:
+    ```json
+    [
+        {"HEATING_COST_CURRENT": 80, "HOT_WATER_COST_CURRENT": 20},
+        {"HEATING_COST_CURRENT": 40}
+    ]
+    ```
+    
+    Example response:
+    ```json
+    {
+        "running_costs": [100, null]
+    }
+    ```
+    """
+    return {"running_costs": [calculate_running_cost(doc) for doc in epc_documents]}
+
+
+# (expires_at, payload) of the last healthy /health response
+_health_cache: Optional[Tuple[float, Dict[str, Any]]] = None
+
+
 @app.get("/health", summary="Health check with index statistics")
 async def health():
-    """Get API health status and OpenSearch index statistics."""
+    """Get API health status and OpenSearch index statistics.
+
+    Healthy responses are cached for HEALTH_CACHE_TTL seconds; failures are not cached.
+    """
+    global _health_cache
+    now = time.monotonic()
+    if _health_cache is not None and _health_cache[0] > now:
+        return _health_cache[1]
+
     try:
-        # Check OpenSearch connectivity
-        cluster_health = opensearch_client.cluster.health()
-        
-        # Get index statistics
-        cert_stats = opensearch_client.count(index=CERTIFICATES_INDEX)
+        # Check OpenSearch connectivity and get index statistics concurrently
+        cluster_health, cert_stats = await asyncio.gather(
+            opensearch_client.cluster.health(),
+            opensearch_client.count(index=CERTIFICATES_INDEX),
+        )
         
-        return {
+        payload = {
             "status": "healthy",
             "opensearch": {
                 "cluster_status": cluster_health.get("status"),
@@ -104,11 +240,15 @@ async def health():
             },
             "indices": {
                 "certificates": CERTIFICATES_INDEX
-            }
+            },
+            "query_cache": query_cache_stats(),
         }
     except Exception as e:
         raise HTTPException(status_code=503, detail=f"Service unhealthy: {str(e)}")
 
+    _health_cache = (now + HEALTH_CACHE_TTL, payload)
+    return payload
+
 
 @app.get("/search", summary="Search places by address")
 async def search(
@@ -122,6 +262,8 @@ async def search(
     min_efficiency: Optional[int] = Query(None, description="Minimum energy efficiency score", ge=0, le=100),
     max_efficiency: Optional[int] = Query(None, description="Maximum energy efficiency score", ge=0, le=100),
     sort_by: Optional[str] = Query(None, description="Sort results by: relevance (default), rating, running_cost"),
+    exact_count: bool = Query(False, description="Count all matches exactly instead of stopping at 10,000"),
+    cursor: Optional[str] = Query(None, description="next_cursor from the previous page; replaces offset"),
 ):
     """
     Parameters:
@@ -133,81 +275,87 @@ async def search(
     - min_efficiency: minimum energy efficiency score
     - max_efficiency: maximum energy efficiency score
     - sort_by: sort results by 'relevance' (default), 'rating', or 'running_cost'
+    - exact_count: count every match; otherwise `total` stops at 10,000 and `total_relation` is 'gte'
+    - cursor: `next_cursor` from the previous response, to fetch the following page
+      without OpenSearch re-sorting and skipping `offset` hits. Can't be combined
+      with a non-zero offset or reused with a different sort_by; `offset` is null
+      in cursor responses
 
     Returns a list of properties from the opensearch-epc db matching the address query.
     """
-    # Log incoming request
-    try:
-        client_ip = request.client.host
-    except Exception:
-        client_ip = None
-    logger.info("/search called address=%s client=%s limit=%d", address, client_ip, limit)
+    if cursor and offset:
+        raise HTTPException(status_code=400, detail="Use either offset or cursor, not both")
+
+    # Build sort clause based on sort_by parameter; full postcodes are
+    # matched in filter context, so there is no score to sort on
+    full_postcode = is_full_postcode(compact_postcode(address))
+    sort_clause = build_sort_clause(sort_by, by_score=not full_postcode)
+    sort_key = search_sort_key(sort_clause)
+    search_after = decode_search_cursor(cursor, sort_key) if cursor else None
 
     try:
         # Build the optimized search query
         query = build_optimized_search_query(
-            address, energy_rating, property_type, min_efficiency, max_efficiency
+            address, energy_rating, property_type, min_efficiency, max_efficiency,
+            full_postcode=full_postcode,
         )
         
-        # Build sort clause based on sort_by parameter
-        sort_clause = build_sort_clause(sort_by)
-        
         # Execute the search with optimizations
         search_body = {
             "query": query,
-            "from": offset,
             "size": limit,
             "sort": sort_clause,
-            "_source": get_source_fields(),
-            "track_total_hits": True,
+            "_source": False,
+            "fields": _SEARCH_FIELDS,
+            "track_total_hits": True if exact_count else TOTAL_HITS_TRACK_LIMIT,
             "timeout": "10s"  # Add timeout to prevent long-running queries
         }
+        if search_after is not None:
+            search_body["search_after"] = search_after
+        else:
+            search_body["from"] = offset
         
-        result = opensearch_client.search(
+        result = await opensearch_client.search(
             index=CERTIFICATES_INDEX,
             body=search_body,
             request_timeout=30
         )
         
         # Process and format the results
+        hits = result['hits']['hits']
         properties = []
-        for hit in result['hits']['hits']:
-            source = hit['_source']
-            property_data = {
-                "id": source.get('LMK_KEY'),
-                "address": format_address(source),
-                "postcode": source.get('POSTCODE'),
-                "uprn": source.get('UPRN'),
-                "current_energy_rating": source.get('CURRENT_ENERGY_RATING'),
-                "potential_energy_rating": source.get('POTENTIAL_ENERGY_RATING'),
-                "current_energy_efficiency": source.get('CURRENT_ENERGY_EFFICIENCY'),
-                "potential_energy_efficiency": source.get('POTENTIAL_ENERGY_EFFICIENCY'),
-                "property_type": source.get('PROPERTY_TYPE'),
-                "built_form": source.get('BUILT_FORM'),
-                "lodgement_date": source.get('LODGEMENT_DATE'),
-                "total_floor_area": source.get('TOTAL_FLOOR_AREA'),
-                "energy_consumption_current": source.get('ENERGY_CONSUMPTION_CURRENT'),
-                "co2_emissions_current": source.get('CO2_EMISSIONS_CURRENT'),
-                "heating_cost_current": source.get('HEATING_COST_CURRENT'),
-                "hot_water_cost_current": source.get('HOT_WATER_COST_CURRENT'),
-                "lighting_cost_current": source.get('LIGHTING_COST_CURRENT'),
-                "construction_age_band": source.get('CONSTRUCTION_AGE_BAND'),
-                "tenure": source.get('TENURE'),
-                "main_fuel": source.get('MAIN_FUEL'),
-                "score": hit['_score'],
-                "running_cost": calculate_running_cost(source)
-            }
+        for hit in hits:
+            # The fields API returns every value as an array; unwrap to a flat doc
+            source = {field: values[0] for field, values in hit.get('fields', {}).items() if values}
+            property_data = {api_name: source.get(field) for api_name, field in _HIT_FIELD_MAP}
+            property_data["address"] = format_address(source)
+            # None for full postcodes, which are matched in filter context
+            property_data["score"] = hit.get('_score')
             properties.append(property_data)
+
+        if logger.isEnabledFor(logging.INFO):
+            client_ip = request.client.host if request is not None and request.client else None
+            position = f"cursor={cursor}" if cursor else f"offset={offset}"
+            logger.info(
+                "/search address=%s client=%s limit=%d %s total=%d took=%dms",
+                address, client_ip, limit, position, result['hits']['total']['value'], result['took'],
+            )
         
-        return {
+        # Returning the response directly skips FastAPI's jsonable_encoder pass
+        # over every hit; the payload is already plain JSON types for orjson
+        return ORJSONResponse({
             "query": address,
             "total": result['hits']['total']['value'],
+            "total_relation": result['hits']['total']['relation'],
             "took": result['took'],
-            "offset": offset,
+            # A cursor page has no numeric position
+            "offset": None if cursor else offset,
             "limit": limit,
             "index_used": CERTIFICATES_INDEX,
-            "results": properties
-        }
+            "results": properties,
+            # A full page may have more after it; resume from its last sort values
+            "next_cursor": encode_search_cursor(sort_key, hits[-1]['sort']) if len(hits) == limit else None,
+        })
         
     except Exception as e:
         logger.error("Search error: %s", str(e))
@@ -216,123 +364,108 @@ async def search(
 
 
 
-def build_sort_clause(sort_by: Optional[str] = None) -> List[Dict[str, Any]]:
+def search_sort_key(sort_clause: List[Dict[str, Any]]) -> str:
+    """Identify a sort clause by its field names, so a cursor is only reused with the sort it came from."""
+    return ",".join(next(iter(clause)) for clause in sort_clause)
+
+
+def encode_search_cursor(sort_key: str, sort_values: List[Any]) -> str:
+    """Encode a hit's sort values (and the sort they belong to) as an opaque, URL-safe cursor."""
+    return base64.urlsafe_b64encode(orjson.dumps({"sort": sort_key, "after": sort_values})).decode("ascii")
+
+
+def decode_search_cursor(cursor: str, sort_key: str) -> List[Any]:
+    """Decode a cursor from encode_search_cursor back into search_after values.
+
+    Raises a 400 if the cursor is malformed or was issued for a different sort.
+    """
+    try:
+        payload = orjson.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except (binascii.Error, ValueError):
+        payload = None
+    values = payload.get("after") if isinstance(payload, dict) else None
+    if not isinstance(values, list) or not values:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if payload.get("sort") != sort_key:
+        raise HTTPException(status_code=400, detail="Cursor does not match this sort_by/query; start again without a cursor")
+    return values
+
+
+_SORT_TIEBREAKER = {"LMK_KEY.keyword": {"order": "asc", "unmapped_type": "keyword"}}
+
+
+def build_sort_clause(sort_by: Optional[str] = None, by_score: bool = True) -> List[Dict[str, Any]]:
     """Build OpenSearch sort clause based on sort_by parameter.
     
     Args:
         sort_by: Sort option - 'relevance', 'rating', or 'running_cost'
+        by_score: Include _score in the sort; False when the query runs in
+            filter context and every hit scores the same
         
     Returns:
         List of sort clauses for OpenSearch
     """
-    # Define energy rating order (A is best, G is worst)
-    rating_order = {"A": 1, "B": 2, "C": 3, "D": 4, "E": 5, "F": 6, "G": 7}
-    
     if sort_by == "rating":
-        # Sort by energy rating (A to G), then by score
-        # Use a script to map ratings to numeric values for proper sorting
-        return [
-            {
-                "_script": {
-                    "type": "number",
-                    "script": {
-                        "lang": "painless",
-                        "source": """
-                            String rating = doc['CURRENT_ENERGY_RATING.keyword'].size() > 0 ? 
-                                doc['CURRENT_ENERGY_RATING.keyword'].value : 'Z';
-                            Map ratings = ['A':1, 'B':2, 'C':3, 'D':4, 'E':5, 'F':6, 'G':7];
-                            return ratings.getOrDefault(rating, 999);
-                        """
-                    },
-                    "order": "asc"
-                }
-            },
+        # Sort by energy rating (A to G), then by score.
+        # current_energy_rating_ord is the 1-7 ordinal stored at ingest time.
+        sort = [
+            {"current_energy_rating_ord": {"order": "asc", "missing": "_last", "unmapped_type": "byte"}},
             {"_score": {"order": "desc"}}
         ]
     elif sort_by == "running_cost":
-        # Sort by running cost (low to high), then by score
-        # We need to calculate running cost in the script since it's computed
-        return [
-            {
-                "_script": {
-                    "type": "number",
-                    "script": {
-                        "lang": "painless",
-                        "source": """
-                            if (doc['HEATING_COST_CURRENT'].size() > 0 && doc['HOT_WATER_COST_CURRENT'].size() > 0) {
-                                return doc['HEATING_COST_CURRENT'].value + doc['HOT_WATER_COST_CURRENT'].value;
-                            }
-                            return 999999;
-                        """
-                    },
-                    "order": "asc"
-                }
-            },
+        # Sort by running cost (low to high), then by score.
+        # running_cost_monthly is computed at ingest time.
+        sort = [
+            {"running_cost_monthly": {"order": "asc", "missing": "_last", "unmapped_type": "double"}},
             {"_score": {"order": "desc"}}
         ]
     else:
         # Default: sort by relevance (score) then by lodgement date
-        return [
+        sort = [
             {"_score": {"order": "desc"}},
-            {"LODGEMENT_DATETIME": {"order": "desc", "missing": "_last"}}
+            # "missing": "_last" is already the default; unmapped_type keeps indices
+            # without the field from failing the sort
+            {"LODGEMENT_DATETIME": {"order": "desc", "unmapped_type": "date"}}
         ]
+    if not by_score:
+        sort = [clause for clause in sort if "_score" not in clause]
+    # Unique tie-breaker so the order is total and search_after cursors are stable
+    sort.append(_SORT_TIEBREAKER)
+    return sort
+
+
+def compact_postcode(address: str) -> str:
+    """Upper-case a postcode and drop its whitespace, the form POSTCODE.keyword is normalized to."""
+    return "".join(address.upper().split())
 
 
+def is_full_postcode(postcode: str) -> bool:
+    """Whether an upper-cased, space-free string is a complete UK postcode (e.g. HP133HH)."""
+    return _FULL_POSTCODE_RE.match(postcode) is not None
+
+
+@lru_cache(maxsize=2048)
 def build_optimized_search_query(
     address: str, 
     energy_rating: Optional[str] = None, 
     property_type: Optional[str] = None,
     min_efficiency: Optional[int] = None,
     max_efficiency: Optional[int] = None,
+    full_postcode: bool = False,
 ) -> Dict[str, Any]:
-    """Build optimized OpenSearch query for postcode search with filters."""
-    
-    # Normalize the postcode input (uppercase, handle spacing)
-    normalized_postcode = address.upper().strip()
-    
-    # Handle different postcode formats (with or without space)
-    postcode_variants = [normalized_postcode]
-    if ' ' in normalized_postcode:
-        # If space exists, also try without space
-        postcode_variants.append(normalized_postcode.replace(' ', ''))
-    else:
-        # If no space, try to add space in typical UK postcode format
-        # UK postcodes are typically: 1-2 letters, 1-2 digits, optional letter, space, 1 digit, 2 letters
-        import re
-        # Try to insert space before last 3 characters if it looks like a postcode
-        if len(normalized_postcode) >= 5 and re.match(r'^[A-Z]{1,2}\d{1,2}[A-Z]?\d[A-Z]{2}$', normalized_postcode):
-            postcode_with_space = normalized_postcode[:-3] + ' ' + normalized_postcode[-3:]
-            postcode_variants.append(postcode_with_space)
+    """Build optimized OpenSearch query for postcode search with filters.
 
-    address_query = {
-        "bool": {
-            "should": [
-                # Exact term match on keyword field (highest priority)
-                {
-                    "terms": {
-                        "POSTCODE.keyword": postcode_variants,
-                        "boost": 10
-                    }
-                },
-                # Exact phrase match on analyzed field (case-insensitive)
-                {
-                    "bool": {
-                        "should": [
-                            {
-                                "match_phrase": {
-                                    "POSTCODE": {
-                                        "query": variant,
-                                        "boost": 8
-                                    }
-                                }
-                            } for variant in postcode_variants
-                        ]
-                    }
-                }
-            ],
-            "minimum_should_match": 1
-        }
-    }
+    ``full_postcode`` is the caller's ``is_full_postcode`` check on the
+    address, so the query and the sort it is paired with agree on whether
+    the search is scored.
+
+    Results are memoized on the arguments and shared between callers, so the
+    returned dict must be treated as read-only.
+    """
+    
+    # POSTCODE.keyword carries a normalizer (uppercase, whitespace stripped) so
+    # "hp13 3hh", "HP133HH" and "HP13 3HH" all match the same term
+    postcode = compact_postcode(address)
     
     # Build filters for certificates index
     filters = []
@@ -358,6 +491,48 @@ def build_optimized_search_query(
             range_filter["range"]["CURRENT_ENERGY_EFFICIENCY"]["lte"] = max_efficiency
         filters.append(range_filter)
     
+    if full_postcode:
+        # A complete postcode is an exact lookup and every hit would score the
+        # same, so run it in filter context and skip scoring altogether. Indices
+        # created before the normalizer keep POSTCODE.keyword verbatim, so also
+        # try the canonical spaced form and fall back to the analyzed phrase.
+        spaced_postcode = f"{postcode[:-3]} {postcode[-3:]}"
+        postcode_filter = {
+            "bool": {
+                "should": [
+                    {"terms": {"POSTCODE.keyword": [postcode, spaced_postcode]}},
+                    {"match_phrase": {"POSTCODE": address}},
+                ],
+                "minimum_should_match": 1,
+            }
+        }
+        return {"bool": {"filter": [postcode_filter] + filters}}
+
+    address_query = {
+        "bool": {
+            "should": [
+                {
+                    "term": {
+                        "POSTCODE.keyword": {
+                            "value": postcode,
+                            "boost": 10
+                        }
+                    }
+                },
+                # Phrase match on the analyzed field for partial postcodes
+                {
+                    "match_phrase": {
+                        "POSTCODE": {
+                            "query": address,
+                            "boost": 8
+                        }
+                    }
+                }
+            ],
+            "minimum_should_match": 1
+        }
+    }
+
     if filters:
         return {
             "bool": {
@@ -369,37 +544,61 @@ def build_optimized_search_query(
         return address_query
 
 
-def get_source_fields() -> Dict[str, List[str]]:
-    """Get optimized source fields based on index type."""
+# Fields joined (in order) to build a result's display address
+_ADDRESS_FIELDS = ('ADDRESS1', 'ADDRESS2', 'ADDRESS3', 'POSTCODE')
+
+def query_cache_stats() -> Dict[str, Any]:
+    """Hit/miss counters for the memoized /search query builder."""
+    info = build_optimized_search_query.cache_info()
+    lookups = info.hits + info.misses
     return {
-        "includes": [
-            "LMK_KEY", "ADDRESS1", "ADDRESS2", "ADDRESS3", "POSTCODE", "UPRN",
-            "CURRENT_ENERGY_RATING", "POTENTIAL_ENERGY_RATING", "CURRENT_ENERGY_EFFICIENCY",
-            "POTENTIAL_ENERGY_EFFICIENCY", "PROPERTY_TYPE", "BUILT_FORM", "LODGEMENT_DATE",
-            "TOTAL_FLOOR_AREA", "ENERGY_CONSUMPTION_CURRENT", "CO2_EMISSIONS_CURRENT",
-            "HEATING_COST_CURRENT", "HOT_WATER_COST_CURRENT", "LIGHTING_COST_CURRENT",
-            "CONSTRUCTION_AGE_BAND", "TENURE", "MAIN_FUEL"
-        ],
-        "excludes": [
-            "*_DESCRIPTION", "*_ENV_EFF", "*_ENERGY_EFF", "RECOMMENDATIONS_*"
-        ]
+        "hits": info.hits,
+        "misses": info.misses,
+        "size": info.currsize,
+        "hit_rate": round(info.hits / lookups, 3) if lookups else None,
     }
 
 
+# (response key, certificate field) pairs copied verbatim onto each /search result;
+# "address" and "score" are filled in separately
+_HIT_FIELD_MAP = (
+    ("id", "LMK_KEY"),
+    ("postcode", "POSTCODE"),
+    ("uprn", "UPRN"),
+    ("current_energy_rating", "CURRENT_ENERGY_RATING"),
+    ("potential_energy_rating", "POTENTIAL_ENERGY_RATING"),
+    ("current_energy_efficiency", "CURRENT_ENERGY_EFFICIENCY"),
+    ("potential_energy_efficiency", "POTENTIAL_ENERGY_EFFICIENCY"),
+    ("property_type", "PROPERTY_TYPE"),
+    ("built_form", "BUILT_FORM"),
+    ("lodgement_date", "LODGEMENT_DATE"),
+    ("total_floor_area", "TOTAL_FLOOR_AREA"),
+    ("energy_consumption_current", "ENERGY_CONSUMPTION_CURRENT"),
+    ("co2_emissions_current", "CO2_EMISSIONS_CURRENT"),
+    ("heating_cost_current", "HEATING_COST_CURRENT"),
+    ("hot_water_cost_current", "HOT_WATER_COST_CURRENT"),
+    ("lighting_cost_current", "LIGHTING_COST_CURRENT"),
+    ("construction_age_band", "CONSTRUCTION_AGE_BAND"),
+    ("tenure", "TENURE"),
+    ("main_fuel", "MAIN_FUEL"),
+    ("running_cost", "running_cost_monthly"),
+)
+
+# Fields fetched for each certificate hit via the fields API instead of _source.
+# LODGEMENT_DATE is formatted to match the value originally stored at ingest.
+_SEARCH_FIELDS: List[Any] = [
+    {"field": field, "format": "strict_date_hour_minute_second"} if field == "LODGEMENT_DATE" else field
+    for _, field in _HIT_FIELD_MAP
+] + [field for field in _ADDRESS_FIELDS if field != "POSTCODE"]
+
+
 def format_address(source: Dict[str, Any]) -> str:
     """Format address from source document."""
-    address_parts = []
-    for field in ['ADDRESS1', 'ADDRESS2', 'ADDRESS3']:
-        value = source.get(field)
-        if value and value.strip():
-            address_parts.append(value.strip())
-    
-    address = ', '.join(address_parts)
-    postcode = source.get('POSTCODE')
-    if postcode and postcode.strip():
-        address += f', {postcode.strip()}'
-    
-    return address
+    return ', '.join(
+        part for part in (
+            (source.get(field) or '').strip() for field in _ADDRESS_FIELDS
+        ) if part
+    )
 
 
 # ---------------------------
@@ -419,23 +618,10 @@ def build_listings_sort_clause(sort_by: Optional[str] = None) -> List[Dict[str,
         List of sort clauses for OpenSearch
     """
     if sort_by == "rating":
-        # Sort by EPC rating (A to G), then by price
+        # Sort by EPC rating (A to G), then by price.
+        # epc_rating_ord is the 1-7 ordinal stored at ingest time.
         return [
-            {
-                "_script": {
-                    "type": "number",
-                    "script": {
-                        "lang": "painless",
-                        "source": """
-                            String rating = doc['epc_rating'].size() > 0 ? 
-                                doc['epc_rating'].value : 'Z';
-                            Map ratings = ['A':1, 'B':2, 'C':3, 'D':4, 'E':5, 'F':6, 'G':7];
-                            return ratings.getOrDefault(rating, 999);
-                        """
-                    },
-                    "order": "asc"
-                }
-            },
+            {"epc_rating_ord": {"order": "asc", "missing": "_last", "unmapped_type": "byte"}},
             {"price": {"order": "asc", "missing": "_last"}},
             {"listed_at": {"order": "desc"}}
         ]
@@ -454,6 +640,46 @@ def build_listings_sort_clause(sort_by: Optional[str] = None) -> List[Dict[str,
         ]
 
 
+# Mean earth radius used by OpenSearch's geo_distance (arc) calculations
+EARTH_RADIUS_KM = 6371.0088
+# Widen the box slightly so float rounding never clips the circle's edge
+_BBOX_PAD = 1.001
+
+
+def _wrap_lon(lon: float) -> float:
+    return ((lon + 180.0) % 360.0) - 180.0
+
+
+def geo_bounding_box(lat: float, lon: float, radius_km: float) -> Optional[Dict[str, Any]]:
+    """Build a geo_bounding_box filter enclosing a circle of radius_km around lat/lon.
+
+    The longitude half-width is the exact great-circle one,
+    asin(sin(d) / cos(lat)) for angular radius d, which is wider than
+    d / cos(lat) at high latitudes. Returns None when the box would span
+    every longitude (the circle reaches a pole, or a huge radius), in which
+    case it wouldn't filter anything.
+    """
+    d = radius_km / EARTH_RADIUS_KM * _BBOX_PAD
+    lat_delta = math.degrees(d)
+    if abs(lat) + lat_delta >= 90.0:
+        return None
+    lon_delta = math.degrees(math.asin(math.sin(d) / math.cos(math.radians(lat))))
+    if lon_delta >= 180.0:
+        return None
+    return {
+        "geo_bounding_box": {
+            "location": {
+                "top_left": {"lat": lat + lat_delta, "lon": _wrap_lon(lon - lon_delta)},
+                "bottom_right": {"lat": lat - lat_delta, "lon": _wrap_lon(lon + lon_delta)},
+            }
+        }
+    }
+
+
+# Constant clause shared by every listings query; never mutated
+_ACTIVE_LISTING_FILTER: Dict[str, Any] = {"term": {"is_active": True}}
+
+
 def build_listings_query(
     q: Optional[str],
     lat: Optional[float],
@@ -467,10 +693,15 @@ def build_listings_query(
     min_price: Optional[float],
     max_price: Optional[float],
 ) -> Dict[str, Any]:
-    filters: List[Dict[str, Any]] = [{"term": {"is_active": True}}]
+    filters: List[Dict[str, Any]] = [_ACTIVE_LISTING_FILTER]
 
     # Location filter
     if lat is not None and lon is not None and radius_km is not None:
+        # A bounding box around the radius circle is cheap to evaluate (BKD tree)
+        # and narrows the candidates before the exact geo_distance check.
+        bbox = geo_bounding_box(lat, lon, radius_km)
+        if bbox:
+            filters.append(bbox)
         filters.append(
             {
                 "geo_distance": {
@@ -509,37 +740,53 @@ def build_listings_query(
             price_range["lte"] = max_price
         filters.append({"range": {"price": price_range}})
 
-    # Text query (postcode/address)
-    must: List[Dict[str, Any]] = []
+    # Text query (postcode/address). Listings are never sorted by _score, so
+    # run it in filter context: no scoring, and the clause is cacheable.
     if q:
-        must.append(
+        filters.append(
             {
                 "bool": {
                     "should": [
-                        {"term": {"postcode": {"value": q.upper(), "boost": 5}}},
-                        {"match": {"address_line": {"query": q, "boost": 2}}},
+                        {"term": {"postcode": {"value": q.upper()}}},
+                        {"match": {"address_line": {"query": q}}},
                     ],
                     "minimum_should_match": 1,
                 }
             }
         )
 
-    query: Dict[str, Any] = {"bool": {}}
-    if must:
-        query["bool"]["must"] = must
-    if filters:
-        query["bool"]["filter"] = filters
-
+    query: Dict[str, Any] = {"bool": {"filter": filters}}
     return query
 
 
+# Pages with more hits than this are streamed one listing at a time
+LISTINGS_STREAM_MIN_HITS = 20
+
+
+def listing_from_hit(hit: Dict[str, Any]) -> Dict[str, Any]:
+    """Flatten a listings hit into its id plus the stored listing fields."""
+    return {"id": hit.get("_id"), **(hit.get("_source") or {})}
+
+
+async def _stream_listings(
+    payload: Dict[str, Any], hits: List[Dict[str, Any]]
+) -> AsyncIterator[bytes]:
+    """Yield ``payload`` as JSON with a ``results`` array encoded per hit,
+    so the full response body is never held in memory at once."""
+    # Reopen the serialized envelope to append the results array as its last key
+    yield orjson.dumps(payload)[:-1] + b',"results":['
+    for i, hit in enumerate(hits):
+        yield (b"," if i else b"") + orjson.dumps(listing_from_hit(hit))
+    yield b"]}"
+
+
 @app.get("/listings/search", summary="Search property listings")
 async def search_listings(
     request: Request,
     response: Response,
     q: Optional[str] = Query(None, description="Address or postcode"),
-    lat: Optional[float] = Query(None, description="Latitude for geo search"),
-    lon: Optional[float] = Query(None, description="Longitude for geo search"),
+    lat: Optional[float] = Query(None, description="Latitude for geo search", ge=-90.0, le=90.0),
+    lon: Optional[float] = Query(None, description="Longitude for geo search", ge=-180.0, le=180.0),
     radius_km: Optional[float] = Query(
         10.0, description="Search radius in km when using geo search", ge=0.1, le=200.0
     ),
@@ -558,6 +805,7 @@ async def search_listings(
     size: int = Query(20, ge=1, le=100),
     offset: int = Query(0, ge=0),
     sort_by: Optional[str] = Query(None, description="Sort results by: price (default), rating, running_cost"),
+    exact_count: bool = Query(False, description="Count all matches exactly instead of stopping at 10,000"),
 ):
     """Search active listings by address/postcode or by lat/lon within a radius,
     and filter by bedrooms, main fuel, solar flags, and max monthly running cost.
@@ -586,7 +834,7 @@ async def search_listings(
             "from": offset,
             "size": size,
             "sort": sort_clause,
-            "track_total_hits": True,
+            "track_total_hits": True if exact_count else TOTAL_HITS_TRACK_LIMIT,
         }
 
         if collapse_per_property:
@@ -599,22 +847,27 @@ async def search_listings(
                 },
             }
 
-        result = opensearch_client.search(
+        result = await opensearch_client.search(
             index=LISTINGS_SEARCH_ALIAS, body=body, request_timeout=30
         )
 
         # Return raw listing docs for now; UI can shape them as needed
         hits = result.get("hits", {}).get("hits", [])
-        listings = [{"id": h.get("_id"), **(h.get("_source") or {})} for h in hits]
-
-        return {
+        payload: Dict[str, Any] = {
             "total": result.get("hits", {}).get("total", {}).get("value", 0),
+            "total_relation": result.get("hits", {}).get("total", {}).get("relation", "eq"),
             "took": result.get("took"),
             "offset": offset,
             "limit": size,
             "index_used": LISTINGS_SEARCH_ALIAS,
-            "results": listings,
         }
+        if len(hits) > LISTINGS_STREAM_MIN_HITS:
+            return StreamingResponse(
+                _stream_listings(payload, hits), media_type="application/json"
+            )
+
+        payload["results"] = [listing_from_hit(h) for h in hits]
+        return payload
     except Exception as e:
         logger.error("Listings search error: %s", str(e))
         raise HTTPException(status_code=500, detail=f"Listings search failed: {str(e)}")
@@ -0,0 +1,71 @@
+"""
+ASGI middleware for the Green Home Search API.
+
+These are plain ASGI callables rather than Starlette ``BaseHTTPMiddleware``
+subclasses, so they add no Request/Response wrapper objects to each call.
+"""
+
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+Scope = Dict[str, Any]
+Message = Dict[str, Any]
+Receive = Callable[[], Awaitable[Message]]
+Send = Callable[[Message], Awaitable[None]]
+ASGIApp = Callable[[Scope, Receive, Send], Awaitable[None]]
+
+
+def _header(headers: List[Tuple[bytes, bytes]], name: bytes) -> Optional[bytes]:
+    """Return the first value of a (lower-case) header from an ASGI header list."""
+    for key, value in headers:
+        if key == name:
+            return value
+    return None
+
+
+class CORSHeadersASGI:
+    """Answer CORS preflights and add ``Access-Control-Allow-Origin`` to responses.
+
+    Only the ``http.response.start`` message is touched; request and response
+    bodies pass straight through.
+
+    Args:
+        app: The wrapped ASGI application
+        allow_origin: Value for the ``Access-Control-Allow-Origin`` header
+        max_age: Seconds browsers may cache a preflight response
+    """
+
+    def __init__(self, app: ASGIApp, allow_origin: bytes = b"*", max_age: int = 600):
+        self.app = app
+        self.allow_origin = allow_origin
+        self.max_age = str(max_age).encode("latin-1")
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_headers = scope["headers"]
+        if scope["method"] == "OPTIONS" and _header(request_headers, b"access-control-request-method"):
+            # Preflight: answer directly without invoking the app
+            allow_headers = _header(request_headers, b"access-control-request-headers") or b"*"
+            await send({
+                "type": "http.response.start",
+                "status": 204,
+                "headers": [
+                    (b"access-control-allow-origin", self.allow_origin),
+                    (b"access-control-allow-methods", b"*"),
+                    (b"access-control-allow-headers", allow_headers),
+                    (b"access-control-max-age", self.max_age),
+                ],
+            })
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        async def send_with_cors(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                headers.append((b"access-control-allow-origin", self.allow_origin))
+                message["headers"] = headers
+            await send(message)
+
+        await self.app(scope, receive, send_with_cors)
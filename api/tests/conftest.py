@@ -0,0 +1,86 @@
+from pathlib import Path
+import sys
+
+import pytest
+from fastapi.testclient import TestClient
+from opensearchpy import OpenSearch
+
+# make the api modules (main, running_cost, ...) importable from every test module
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import main
+from main import app
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        "markers", "opensearch: test queries a live OpenSearch cluster; skipped when it is unreachable"
+    )
+
+
+@pytest.fixture(scope="session")
+def client():
+    """Test client shared by the whole session; app startup/shutdown run once."""
+    with TestClient(app) as test_client:
+        yield test_client
+
+
+class _FakeCluster:
+    def __init__(self):
+        self.calls = 0
+
+    async def health(self):
+        self.calls += 1
+        return {"status": "green"}
+
+
+class _FakeOpenSearch:
+    """Stand-in for main.opensearch_client that returns canned hits and records request bodies."""
+
+    def __init__(self, hits=None):
+        self.cluster = _FakeCluster()
+        self.hits = hits or []
+        self.bodies = []
+
+    async def count(self, index):
+        return {"count": 42}
+
+    async def search(self, index, body, **kwargs):
+        self.bodies.append(body)
+        return {
+            "took": 1,
+            "hits": {"total": {"value": len(self.hits), "relation": "eq"}, "hits": self.hits},
+        }
+
+
+@pytest.fixture
+def fake_opensearch(monkeypatch):
+    """Swap the app's OpenSearch client for a fake; call with the hits to return."""
+    def install(hits=None):
+        fake = _FakeOpenSearch(hits=hits)
+        monkeypatch.setattr(main, "opensearch_client", fake)
+        return fake
+
+    return install
+
+
+@pytest.fixture(scope="session")
+def opensearch_available() -> bool:
+    """Probe OpenSearch once per session, failing fast instead of per-test timeouts."""
+    probe = OpenSearch(
+        hosts=[main.OPENSEARCH_URL],
+        http_auth=(main.OPENSEARCH_USER, main.OPENSEARCH_PASS) if main.OPENSEARCH_USER and main.OPENSEARCH_PASS else None,
+        timeout=1,
+        max_retries=0,
+    )
+    try:
+        return probe.ping()
+    finally:
+        probe.close()
+
+
+@pytest.fixture(autouse=True)
+def _skip_without_opensearch(request):
+    if request.node.get_closest_marker("opensearch") and not request.getfixturevalue("opensearch_available"):
+        pytest.skip("OpenSearch is not reachable")
@@ -1,60 +1,56 @@
-from pathlib import Path
-import sys
-import pytest
-import asyncio
-
-# ensure api root is importable
-ROOT = Path(__file__).resolve().parent.parent
-sys.path.insert(0, str(ROOT))
-
-from main import search, get_running_cost
-
-
-def test_search_returns_results():
-    # Call the async search() function directly to avoid TestClient/httpx compatibility issues
-    results = asyncio.run(search(None, address='High Wycombe'))
-    assert isinstance(results, list)
-    assert len(results) >= 1
-    first = results[0]
-    assert hasattr(first, 'id') and hasattr(first, 'name') and hasattr(first, 'lat') and hasattr(first, 'lng')
-
-
-def test_running_cost_with_valid_rating():
-    """Test running cost endpoint with valid cost data."""
-    epc_doc = {"HEATING_COST_CURRENT": 80, "HOT_WATER_COST_CURRENT": 20}
-    result = asyncio.run(get_running_cost(epc_doc))
-    assert result == {"running_cost": 100}
-
-
-def test_running_cost_with_different_rating():
-    """Test running cost endpoint with different valid costs."""
-    epc_doc = {"HEATING_COST_CURRENT": 30, "HOT_WATER_COST_CURRENT": 20}
-    result = asyncio.run(get_running_cost(epc_doc))
-    assert result == {"running_cost": 50}
-
-
-def test_running_cost_with_uppercase_field():
-    """Test running cost endpoint with uppercase field names."""
-    epc_doc = {"HEATING_COST_CURRENT": 120, "HOT_WATER_COST_CURRENT": 30}
-    result = asyncio.run(get_running_cost(epc_doc))
-    assert result == {"running_cost": 150}
-
-
-def test_running_cost_with_invalid_rating():
-    """Test running cost endpoint with missing cost data."""
-    epc_doc = {"current-energy-rating": "Z"}
-    result = asyncio.run(get_running_cost(epc_doc))
-    assert result == {"running_cost": None}
-from fastapi.testclient import TestClient
-from main import app
-
-
-@pytest.fixture
-def client():
-    """Create a test client for the FastAPI app."""
-    return TestClient(app)
+import io
+import logging
+import math
+from datetime import date
 
+import pytest
 
+import main
+from main import (
+    EARTH_RADIUS_KM,
+    ORJSONSerializer,
+    build_listings_query,
+    build_listings_sort_clause,
+    build_optimized_search_query,
+    build_sort_clause,
+    compact_postcode,
+    format_address,
+    geo_bounding_box,
+    get_running_cost,
+    is_full_postcode,
+    query_cache_stats,
+)
+
+# EPC rating letters in sort order (best first), as stored in current_energy_rating_ord
+RATING_ORDER = {"A": 1, "B": 2, "C": 3, "D": 4, "E": 5, "F": 6, "G": 7}
+
+
+def assert_all_in_range(results, field, lo, hi):
+    """Assert every result with a value for ``field`` has it within [lo, hi]."""
+    out_of_range = [
+        value for value in (result.get(field) for result in results)
+        if value is not None and not lo <= value <= hi
+    ]
+    assert not out_of_range, f"{field} values {out_of_range} outside range [{lo}, {hi}]"
+
+
+@pytest.mark.parametrize(
+    "epc_doc, expected",
+    [
+        ({"HEATING_COST_CURRENT": 80, "HOT_WATER_COST_CURRENT": 20}, 100),
+        ({"HEATING_COST_CURRENT": 30, "HOT_WATER_COST_CURRENT": 20}, 50),
+        ({"HEATING_COST_CURRENT": 120, "HOT_WATER_COST_CURRENT": 30}, 150),
+        ({"current-energy-rating": "Z"}, None),
+    ],
+)
+@pytest.mark.asyncio(loop_scope="session")
+async def test_running_cost(epc_doc, expected):
+    """Test the running cost endpoint sums the cost fields, or returns null without them."""
+    result = await get_running_cost(epc_doc)
+    assert result == {"running_cost": expected}
+
+
+@pytest.mark.opensearch
 def test_search_returns_results(client):
     """Test that search endpoint returns properly structured results."""
     response = client.get("/search?address=High Wycombe&limit=5")
@@ -96,6 +92,7 @@ def test_search_returns_results(client):
         assert first_result["running_cost"] is None or isinstance(first_result["running_cost"], (int, float))
 
 
+@pytest.mark.opensearch
 def test_search_with_filters(client):
     """Test search with energy rating and property type filters."""
     response = client.get("/search?address=London&energy_rating=C&property_type=House&limit=3")
@@ -115,6 +112,7 @@ def test_search_with_filters(client):
             assert result["property_type"] == "House"
 
 
+@pytest.mark.opensearch
 def test_search_with_efficiency_range(client):
     """Test search with energy efficiency range filter."""
     response = client.get("/search?address=Manchester&min_efficiency=60&max_efficiency=80&limit=5")
@@ -126,32 +124,28 @@ def test_search_with_efficiency_range(client):
     assert "results" in data
     
     # If results exist, check efficiency is within range
-    for result in data["results"]:
-        if result.get("current_energy_efficiency") is not None:
-            efficiency = result["current_energy_efficiency"]
-            assert 60 <= efficiency <= 80
+    assert_all_in_range(data["results"], "current_energy_efficiency", 60, 80)
 
 
+@pytest.mark.opensearch
 def test_search_pagination(client):
-    """Test search pagination works correctly."""
-    # Get first page
-    response1 = client.get("/search?address=London&limit=2&offset=0")
-    assert response1.status_code == 200
-    data1 = response1.json()
-    
-    # Get second page
+    """Test that an offset page matches the same slice of one larger page."""
+    # One request covering the first two pages of two
+    response = client.get("/search?address=London&limit=4&offset=0")
+    assert response.status_code == 200
+    data = response.json()
+    results = data["results"]
+    assert len(results) <= 4
+
+    # The second page on its own exercises the backend's offset handling
     response2 = client.get("/search?address=London&limit=2&offset=2")
     assert response2.status_code == 200
     data2 = response2.json()
-    
-    # Both should have same total but different offsets
-    assert data1["total"] == data2["total"]
-    assert data1["offset"] == 0
+
+    assert data2["total"] == data["total"]
     assert data2["offset"] == 2
-    
-    # Results should be different (if enough results exist)
-    if data1["total"] > 2 and len(data1["results"]) > 0 and len(data2["results"]) > 0:
-        assert data1["results"][0]["id"] != data2["results"][0]["id"]
+    # Sorts end in a unique tie-breaker, so the order is stable between requests
+    assert [r["id"] for r in data2["results"]] == [r["id"] for r in results[2:4]]
 
 
 def test_search_invalid_parameters(client):
@@ -172,6 +166,7 @@ def test_search_invalid_parameters(client):
     assert response.status_code == 422
 
 
+@pytest.mark.opensearch
 def test_health_endpoint(client):
     """Test health endpoint returns proper status."""
     response = client.get("/health")
@@ -183,6 +178,7 @@ def test_health_endpoint(client):
     assert "indices" in data
 
 
+@pytest.mark.opensearch
 def test_search_includes_running_cost(client):
     """Test that search results include running cost calculations."""
     response = client.get("/search?address=High Wycombe&limit=10")
@@ -208,6 +204,7 @@ def test_search_includes_running_cost(client):
                 assert result["running_cost"] is None
 
 
+@pytest.mark.opensearch
 def test_search_sort_by_rating(client):
     """Test that search results can be sorted by EPC rating."""
     response = client.get("/search?address=London&limit=10&sort_by=rating")
@@ -218,8 +215,17 @@ def test_search_sort_by_rating(client):
     # Check basic structure
     assert "results" in data
     assert "total" in data
-    
-   
+
+    # Rated results come back best rating first (unrated ones sort last)
+    ranks = []
+    for result in data["results"]:
+        rank = RATING_ORDER.get(result.get("current_energy_rating"), 0)
+        if rank:
+            ranks.append(rank)
+    assert ranks == sorted(ranks)
+
+
+@pytest.mark.opensearch
 def test_listings_search_with_price_filter(client):
     """Test listings search with price range filter."""
     response = client.get("/listings/search?q=London&min_price=100000&max_price=500000&size=5")
@@ -232,9 +238,319 @@ def test_listings_search_with_price_filter(client):
     assert "total" in data
     
     # If results exist, check they match price filters
-    for result in data["results"]:
-        if result.get("price") is not None:
-            price = result["price"]
-            assert 100000 <= price <= 500000, f"Price {price} outside range [100000, 500000]"
+    assert_all_in_range(data["results"], "price", 100000, 500000)
+
+
+
+
+def test_cors_preflight(client):
+    """Test that CORS preflight requests are answered without hitting the endpoint."""
+    response = client.options(
+        "/search",
+        headers={
+            "Origin": "http://localhost:5173",
+            "Access-Control-Request-Method": "GET",
+            "Access-Control-Request-Headers": "content-type",
+        },
+    )
+
+    assert response.status_code == 204
+    assert response.headers["access-control-allow-origin"] == "*"
+    assert response.headers["access-control-allow-headers"] == "content-type"
+
+
+def test_cors_header_on_response(client):
+    """Test that regular responses carry the CORS allow-origin header."""
+    response = client.get("/", headers={"Origin": "http://localhost:5173"})
+
+    assert response.status_code == 200
+    assert response.headers["access-control-allow-origin"] == "*"
+
+
+def test_sort_by_rating_uses_stored_ordinal():
+    """Test that rating sorts read the numeric ordinal field instead of a script."""
+    assert "current_energy_rating_ord" in build_sort_clause("rating")[0]
+    assert "epc_rating_ord" in build_listings_sort_clause("rating")[0]
+
+
+def test_sort_by_running_cost_uses_stored_field():
+    """Test that running cost sorts read the field precomputed at ingest."""
+    assert "running_cost_monthly" in build_sort_clause("running_cost")[0]
+
+
+def test_listings_geo_query_prefilters_with_bounding_box():
+    """Test that geo searches add a bounding box enclosing the radius before geo_distance."""
+    query = build_listings_query(
+        q=None, lat=51.63, lon=-0.75, radius_km=10.0, bedrooms_min=None,
+        main_fuel=None, solar_panels=None, solar_water_heating=None,
+        running_cost_monthly_max=None, min_price=None, max_price=None,
+    )
+    filters = query["bool"]["filter"]
+    kinds = [next(iter(f)) for f in filters]
+    assert kinds.index("geo_bounding_box") < kinds.index("geo_distance")
+
+    box = filters[kinds.index("geo_bounding_box")]["geo_bounding_box"]["location"]
+    assert box["bottom_right"]["lat"] < 51.63 - 0.09 < 51.63 + 0.09 < box["top_left"]["lat"]
+    assert box["top_left"]["lon"] < -0.75 - 0.14 < -0.75 + 0.14 < box["bottom_right"]["lon"]
+
+
+@pytest.mark.parametrize("lat,lon,radius_km", [(51.63, -0.75, 10.0), (80.0, 20.0, 200.0), (-75.0, 179.5, 200.0)])
+def test_bounding_box_encloses_radius_circle(lat, lon, radius_km):
+    """Test that every point on the radius circle lies inside the bounding box, even near the poles."""
+    box = geo_bounding_box(lat, lon, radius_km)["geo_bounding_box"]["location"]
+    west, east = box["top_left"]["lon"], box["bottom_right"]["lon"]
+    d = radius_km / EARTH_RADIUS_KM
+    lat1, lon1 = math.radians(lat), math.radians(lon)
+    for bearing_deg in range(360):
+        bearing = math.radians(bearing_deg)
+        # Destination point at distance d along the bearing (great circle)
+        lat2 = math.asin(math.sin(lat1) * math.cos(d) + math.cos(lat1) * math.sin(d) * math.cos(bearing))
+        lon2 = lon1 + math.atan2(math.sin(bearing) * math.sin(d) * math.cos(lat1),
+                                 math.cos(d) - math.sin(lat1) * math.sin(lat2))
+        point_lat = math.degrees(lat2)
+        point_lon = ((math.degrees(lon2) + 180.0) % 360.0) - 180.0
+        assert box["bottom_right"]["lat"] <= point_lat <= box["top_left"]["lat"]
+        # The box may cross the antimeridian (west > east)
+        if west <= east:
+            assert west <= point_lon <= east
+        else:
+            assert point_lon >= west or point_lon <= east
+
+
+def test_listings_search_rejects_out_of_range_latitude(client):
+    """Test that /listings/search validates lat/lon ranges."""
+    assert client.get("/listings/search", params={"lat": 95, "lon": 0}).status_code == 422
+    assert client.get("/listings/search", params={"lat": 51.6, "lon": 181}).status_code == 422
+
+
+def test_search_query_is_memoized():
+    """Test that identical search inputs reuse the cached query body."""
+    first = build_optimized_search_query("HP13 3HH", "C", None, 60, None)
+    second = build_optimized_search_query("HP13 3HH", "C", None, 60, None)
+    assert first is second
+    assert build_optimized_search_query("HP13 3HH") is not first
+
+
+def test_full_postcode_query_is_an_unscored_filter():
+    """Test that complete postcodes run as a filter-context term and partial ones keep the phrase branch."""
+    def postcode_filter(address):
+        # Normalized and verbatim keyword forms, plus a phrase match for
+        # indices created before the postcode normalizer
+        return {"bool": {
+            "should": [
+                {"terms": {"POSTCODE.keyword": ["HP133HH", "HP13 3HH"]}},
+                {"match_phrase": {"POSTCODE": address}},
+            ],
+            "minimum_should_match": 1,
+        }}
+
+    assert is_full_postcode(compact_postcode("hp13 3hh"))
+    assert build_optimized_search_query("hp13 3hh", full_postcode=True) == {
+        "bool": {"filter": [postcode_filter("hp13 3hh")]}
+    }
+    assert build_optimized_search_query("HP133HH", "c", full_postcode=True) == {
+        "bool": {"filter": [postcode_filter("HP133HH"), {"term": {"CURRENT_ENERGY_RATING.keyword": "C"}}]}
+    }
+    assert build_sort_clause(None, by_score=False)[0] == {
+        "LODGEMENT_DATETIME": {"order": "desc", "unmapped_type": "date"}
+    }
+    assert all("_score" not in clause for clause in build_sort_clause("rating", by_score=False))
+
+    assert not is_full_postcode(compact_postcode("HP13"))
+    partial = build_optimized_search_query("HP13")
+    clauses = partial["bool"]["should"]
+    assert clauses[0] == {"term": {"POSTCODE.keyword": {"value": "HP13", "boost": 10}}}
+    assert "match_phrase" in clauses[1]
+
+
+def test_query_cache_stats_report_hit_rate():
+    """Test that the query cache counters reflect lookups against the memoized builder."""
+    build_optimized_search_query.cache_clear()
+    assert query_cache_stats()["hit_rate"] is None
+
+    build_optimized_search_query("SW1A 1AA")
+    build_optimized_search_query("SW1A 1AA")
+    build_optimized_search_query("SW1A 1AA")
+    build_optimized_search_query("HP13 3HH")
+    assert query_cache_stats() == {"hits": 2, "misses": 2, "size": 2, "hit_rate": 0.5}
+
+
+def test_orjson_serializer_round_trip():
+    """Test the OpenSearch client serializer encodes and decodes request/response bodies."""
+    serializer = ORJSONSerializer()
+    body = {"query": {"term": {"POSTCODE.keyword": "HP13 3HH"}}, "size": 5, "since": date(2024, 1, 2)}
+
+    encoded = serializer.dumps(body)
+    assert isinstance(encoded, str)
+    assert serializer.loads(encoded) == {**body, "since": "2024-01-02"}
+    assert serializer.dumps('{"already": "encoded"}') == '{"already": "encoded"}'
+
+
+def test_listings_text_query_runs_in_filter_context():
+    """Test that the listings postcode/address clause is a filter, not a scored must."""
+    query = build_listings_query(
+        q="hp13 3hh", lat=None, lon=None, radius_km=None, bedrooms_min=2,
+        main_fuel=None, solar_panels=None, solar_water_heating=None,
+        running_cost_monthly_max=None, min_price=None, max_price=None,
+    )
+    assert "must" not in query["bool"]
+    text_clause = query["bool"]["filter"][-1]["bool"]
+    assert {"term": {"postcode": {"value": "HP13 3HH"}}} in text_clause["should"]
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_health_is_cached_briefly(monkeypatch, fake_opensearch):
+    """Test that repeated health probes within the TTL reuse the last response."""
+    fake = fake_opensearch()
+    monkeypatch.setattr(main, "_health_cache", None)
+
+    first = await main.health()
+    second = await main.health()
+
+    assert first == second
+    assert first["opensearch"] == {"cluster_status": "green", "certificates_count": 42}
+    assert "hit_rate" in first["query_cache"]
+    assert fake.cluster.calls == 1
+
+
+def test_search_reads_fields_projection(client, fake_opensearch):
+    """Test that /search requests flat fields instead of _source and unwraps them."""
+    fake = fake_opensearch(hits=[{
+        # full postcodes run in filter context, so hits carry no score
+        "_score": None,
+        "fields": {
+            "LMK_KEY": ["abc123"],
+            "ADDRESS1": ["12 Rosevale Gardens"],
+            "ADDRESS3": ["High Wycombe"],
+            "POSTCODE": ["HP13 3HH"],
+            "CURRENT_ENERGY_RATING": ["C"],
+            "HEATING_COST_CURRENT": [80],
+            "HOT_WATER_COST_CURRENT": [20],
+            "running_cost_monthly": [100],
+        },
+    }])
+
+    response = client.get("/search?address=HP13 3HH&limit=5")
+
+    assert response.status_code == 200
+    assert fake.bodies[0]["_source"] is False
+    result = response.json()["results"][0]
+    assert result["id"] == "abc123"
+    assert result["address"] == "12 Rosevale Gardens, High Wycombe, HP13 3HH"
+    assert result["current_energy_rating"] == "C"
+    assert result["running_cost"] == 100
+    assert result["tenure"] is None
+    assert result["score"] is None
+
 
+def test_search_log_line_propagates(client, caplog, fake_opensearch):
+    """Test that the per-request /search log line reaches the root logger."""
+    fake_opensearch(hits=[])
 
+    with caplog.at_level(logging.INFO, logger="green-home-search.api"):
+        client.get("/search?address=HP13 3HH&limit=5")
+
+    assert any(r.getMessage().startswith("/search address=HP13 3HH") for r in caplog.records)
+
+
+def test_log_fallback_outside_lifespan(monkeypatch):
+    """Test that INFO logs are written outside the app lifespan only while logging is unconfigured."""
+    stream = io.StringIO()
+    monkeypatch.setattr(main._log_fallback_handler, "stream", stream)
+
+    main.logger.info("configured elsewhere")
+    assert stream.getvalue() == ""
+
+    monkeypatch.setattr(logging.getLogger(), "handlers", [])
+    main.logger.info("imported by a script")
+    assert "INFO green-home-search.api: imported by a script" in stream.getvalue()
+
+
+def test_running_cost_batch(client):
+    """Test that the batch endpoint returns one cost per document, in order."""
+    docs = [
+        {"HEATING_COST_CURRENT": 80, "HOT_WATER_COST_CURRENT": 20},
+        {"HEATING_COST_CURRENT": 40},
+        {"HEATING_COST_CURRENT": 30, "HOT_WATER_COST_CURRENT": 20},
+    ]
+    response = client.post("/running-cost/batch", json=docs)
+    assert response.status_code == 200
+    assert response.json() == {"running_costs": [100, None, 50]}
+    assert client.post("/running-cost/batch", json=[]).json() == {"running_costs": []}
+
+
+def test_format_address_skips_blank_parts():
+    """Test that blank or missing address lines are skipped, including before the postcode."""
+    assert format_address({"ADDRESS1": " 1 High St ", "ADDRESS2": "  ", "ADDRESS3": "Wycombe", "POSTCODE": "HP13 3HH "}) == "1 High St, Wycombe, HP13 3HH"
+    assert format_address({"ADDRESS1": None, "POSTCODE": "HP13 3HH"}) == "HP13 3HH"
+    assert format_address({}) == ""
+
+
+def test_total_hits_are_bounded_unless_exact_count(client, fake_opensearch):
+    """Test that totals stop at the tracking limit by default and exact_count lifts it."""
+    fake = fake_opensearch()
+
+    response = client.get("/search?address=HP13 3HH")
+    assert response.status_code == 200
+    assert response.json()["total_relation"] == "eq"
+    client.get("/search?address=HP13 3HH&exact_count=true")
+    client.get("/listings/search?q=HP13")
+    client.get("/listings/search?q=HP13&exact_count=true")
+
+    tracking = [body["track_total_hits"] for body in fake.bodies]
+    assert tracking == [main.TOTAL_HITS_TRACK_LIMIT, True, main.TOTAL_HITS_TRACK_LIMIT, True]
+
+
+def test_large_listings_pages_are_streamed(client, fake_opensearch):
+    """Test that big listings pages stream the same JSON shape as small ones."""
+    hits = [{"_id": str(i), "_source": {"price": 1000 + i}} for i in range(main.LISTINGS_STREAM_MIN_HITS + 5)]
+    fake_opensearch(hits=hits)
+
+    streamed = client.get("/listings/search?q=HP13&size=50")
+    assert streamed.status_code == 200
+    assert streamed.headers["content-type"] == "application/json"
+    data = streamed.json()
+    assert data["total"] == len(hits)
+    assert data["results"][0] == {"id": "0", "price": 1000}
+    assert len(data["results"]) == len(hits)
+
+    fake_opensearch(hits=hits[:3])
+    small = client.get("/listings/search?q=HP13").json()
+    assert set(small) == set(data)
+
+
+def test_search_cursor_pagination(client, fake_opensearch):
+    """Test that a full page returns next_cursor and passing it back uses search_after."""
+    hits = [{"_score": 1.0, "sort": [1.0, 1700000000000 - i, f"key{i}"], "fields": {"LMK_KEY": [f"key{i}"]}} for i in range(2)]
+    fake = fake_opensearch(hits=hits)
+
+    first = client.get("/search?address=High Wycombe&limit=2").json()
+    assert fake.bodies[0]["from"] == 0
+    assert first["next_cursor"]
+    assert list(fake.bodies[0]["sort"][-1]) == ["LMK_KEY.keyword"]
+
+    second = client.get("/search", params={"address": "High Wycombe", "limit": 2, "cursor": first["next_cursor"]}).json()
+    assert fake.bodies[1]["search_after"] == hits[-1]["sort"]
+    assert "from" not in fake.bodies[1]
+    assert second["offset"] is None
+
+    last = client.get("/search?address=High Wycombe&limit=3").json()
+    assert last["next_cursor"] is None
+
+    assert client.get("/search?address=High Wycombe&cursor=not-a-cursor").status_code == 400
+
+
+def test_search_cursor_rejects_other_sort_or_offset(client, fake_opensearch):
+    """Test that a cursor can't be reused with a different sort or combined with an offset."""
+    hits = [{"_score": 1.0, "sort": [1.0, 1700000000000, "key0"], "fields": {"LMK_KEY": ["key0"]}}]
+    fake = fake_opensearch(hits=hits)
+    cursor = client.get("/search?address=High Wycombe&limit=1").json()["next_cursor"]
+
+    other_sort = client.get("/search", params={"address": "High Wycombe", "sort_by": "rating", "cursor": cursor})
+    assert other_sort.status_code == 400
+    # A full postcode drops _score from the sort, so the relevance cursor doesn't fit it either
+    full_postcode = client.get("/search", params={"address": "HP13 3HH", "cursor": cursor})
+    assert full_postcode.status_code == 400
+    with_offset = client.get("/search", params={"address": "High Wycombe", "offset": 20, "cursor": cursor})
+    assert with_offset.status_code == 400
+    assert len(fake.bodies) == 1
@@ -22,10 +22,22 @@ import argparse
 import os
 import sys
 from datetime import datetime, timezone
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, Iterator, List, Optional, Tuple
 
 from opensearchpy import OpenSearch, helpers
 
+from ingest import (
+    BULK_LOAD_SETTINGS,
+    finish_bulk_load,
+    make_serializer,
+    restore_after_failed_load,
+    tune_chunk_size,
+)
+
+# parallel_bulk defaults, also used for the CLI flags
+DEFAULT_BULK_THREADS = os.cpu_count() or 4
+DEFAULT_MAX_CHUNK_BYTES = 50 * 1024 * 1024
+
 
 def create_property_mapping() -> Dict[str, Any]:
     """
@@ -35,6 +47,8 @@ def create_property_mapping() -> Dict[str, Any]:
         Mapping configuration for the properties index
     """
     return {
+        # Relaxed for the build; build_properties_index restores them afterwards
+        'settings': {'index': dict(BULK_LOAD_SETTINGS)},
         'mappings': {
             'properties': {
                 'uprn': {'type': 'keyword'},
@@ -116,20 +130,23 @@ def extract_address(cert: Dict[str, Any]) -> Dict[str, Any]:
     Returns:
         Address object with structured fields
     """
+    g = cert.get
+    address1 = g('ADDRESS1', '')
+    address2 = g('ADDRESS2', '')
+    address3 = g('ADDRESS3', '')
+    postcode = g('POSTCODE', '')
     address = {
-        'address1': cert.get('ADDRESS1', ''),
-        'address2': cert.get('ADDRESS2', ''),
-        'address3': cert.get('ADDRESS3', ''),
-        'postcode': cert.get('POSTCODE', '')
+        'address1': address1,
+        'address2': address2,
+        'address3': address3,
+        'postcode': postcode,
+        # Full address from the non-empty components
+        'address': ', '.join([p for p in (address1, address2, address3, postcode) if p])
     }
     
-    # Build full address from components
-    parts = [address['address1'], address['address2'], address['address3'], address['postcode']]
-    address['address'] = ', '.join([p for p in parts if p])
-    
     # Extract location if available
-    if 'location' in cert and cert['location']:
-        loc = cert['location']
+    loc = g('location')
+    if loc:
         if isinstance(loc, dict):
             address['lat'] = loc.get('lat')
             address['long'] = loc.get('lon')
@@ -146,6 +163,10 @@ def extract_address(cert: Dict[str, Any]) -> Dict[str, Any]:
     return address
 
 
+# SOLAR_WATER_HEATING_FLAG values (upper-cased) that mean the property has it
+_SOLAR_WATER_TRUE = frozenset({'Y', 'YES', 'TRUE'})
+
+
 def extract_latest_epc(cert: Dict[str, Any]) -> Dict[str, Any]:
     """
     Extract latest EPC information from the most recent certificate.
@@ -156,38 +177,34 @@ def extract_latest_epc(cert: Dict[str, Any]) -> Dict[str, Any]:
     Returns:
         Latest EPC object with key fields
     """
-    latest_epc = {
-        'LMK_KEY': cert.get('LMK_KEY'),
-        'rating': cert.get('CURRENT_ENERGY_RATING'),
-        'score': cert.get('CURRENT_ENERGY_EFFICIENCY'),
-        'inspection_date': cert.get('INSPECTION_DATE'),
-        'lodgement_date': cert.get('LODGEMENT_DATE'),
-        'property_type': cert.get('PROPERTY_TYPE'),
-        'built_form': cert.get('BUILT_FORM'),
-        'construction_age_band': cert.get('CONSTRUCTION_AGE_BAND'),
-        'total_floor_area': cert.get('TOTAL_FLOOR_AREA'),
-        'heating_type': cert.get('MAINHEAT_DESCRIPTION'),
-        'wall_insulation': cert.get('WALLS_DESCRIPTION'),
-        'roof_description': cert.get('ROOF_DESCRIPTION'),
-        'windows_description': cert.get('WINDOWS_DESCRIPTION'),
-        'main_fuel': cert.get('MAIN_FUEL'),
-        'wind_turbine_count': cert.get('WIND_TURBINE_COUNT', 0),
-        'co2_emissions_current': cert.get('CO2_EMISSIONS_CURRENT'),
-        'energy_consumption_current': cert.get('ENERGY_CONSUMPTION_CURRENT'),
-        'heating_cost_current': cert.get('HEATING_COST_CURRENT'),
-        'hot_water_cost_current': cert.get('HOT_WATER_COST_CURRENT'),
-        'lighting_cost_current': cert.get('LIGHTING_COST_CURRENT')
+    g = cert.get
+    photo_supply = g('PHOTO_SUPPLY', 0)
+    solar_water = g('SOLAR_WATER_HEATING_FLAG', '') or ''
+    return {
+        'LMK_KEY': g('LMK_KEY'),
+        'rating': g('CURRENT_ENERGY_RATING'),
+        'score': g('CURRENT_ENERGY_EFFICIENCY'),
+        'inspection_date': g('INSPECTION_DATE'),
+        'lodgement_date': g('LODGEMENT_DATE'),
+        'property_type': g('PROPERTY_TYPE'),
+        'built_form': g('BUILT_FORM'),
+        'construction_age_band': g('CONSTRUCTION_AGE_BAND'),
+        'total_floor_area': g('TOTAL_FLOOR_AREA'),
+        'heating_type': g('MAINHEAT_DESCRIPTION'),
+        'wall_insulation': g('WALLS_DESCRIPTION'),
+        'roof_description': g('ROOF_DESCRIPTION'),
+        'windows_description': g('WINDOWS_DESCRIPTION'),
+        'main_fuel': g('MAIN_FUEL'),
+        'wind_turbine_count': g('WIND_TURBINE_COUNT', 0),
+        'co2_emissions_current': g('CO2_EMISSIONS_CURRENT'),
+        'energy_consumption_current': g('ENERGY_CONSUMPTION_CURRENT'),
+        'heating_cost_current': g('HEATING_COST_CURRENT'),
+        'hot_water_cost_current': g('HOT_WATER_COST_CURRENT'),
+        'lighting_cost_current': g('LIGHTING_COST_CURRENT'),
+        # Solar panels: PHOTO_SUPPLY > 0
+        'solar_panels': bool(photo_supply and float(photo_supply) > 0),
+        'solar_water_heating': solar_water.upper() in _SOLAR_WATER_TRUE,
     }
-    
-    # Check for solar panels (PHOTO_SUPPLY > 0)
-    photo_supply = cert.get('PHOTO_SUPPLY', 0)
-    latest_epc['solar_panels'] = bool(photo_supply and float(photo_supply) > 0)
-    
-    # Check for solar water heating
-    solar_water = cert.get('SOLAR_WATER_HEATING_FLAG', '') or ''
-    latest_epc['solar_water_heating'] = solar_water.upper() in ('Y', 'YES', 'TRUE')
-    
-    return latest_epc
 
 
 def extract_epc_summary(cert: Dict[str, Any]) -> Dict[str, Any]:
@@ -200,22 +217,29 @@ def extract_epc_summary(cert: Dict[str, Any]) -> Dict[str, Any]:
     Returns:
         EPC summary object with key fields
     """
+    g = cert.get
     return {
-        'LMK_KEY': cert.get('LMK_KEY'),
-        'rating': cert.get('CURRENT_ENERGY_RATING'),
-        'score': cert.get('CURRENT_ENERGY_EFFICIENCY'),
-        'inspection_date': cert.get('INSPECTION_DATE'),
-        'lodgement_date': cert.get('LODGEMENT_DATE')
+        'LMK_KEY': g('LMK_KEY'),
+        'rating': g('CURRENT_ENERGY_RATING'),
+        'score': g('CURRENT_ENERGY_EFFICIENCY'),
+        'inspection_date': g('INSPECTION_DATE'),
+        'lodgement_date': g('LODGEMENT_DATE')
     }
 
 
-def build_property_document(uprn: str, certificates: List[Dict[str, Any]]) -> Dict[str, Any]:
+def build_property_document(
+    uprn: str,
+    certificates: List[Dict[str, Any]],
+    now_iso: Optional[str] = None
+) -> Dict[str, Any]:
     """
     Build a property document from a list of certificates for the same UPRN.
     
     Args:
         uprn: The property UPRN
         certificates: List of certificate documents, should be sorted by date (newest first)
+        now_iso: created_at timestamp (ISO 8601); defaults to the current UTC time.
+            build_properties_index passes one timestamp for the whole build
         
     Returns:
         Property document ready for indexing
@@ -231,103 +255,127 @@ def build_property_document(uprn: str, certificates: List[Dict[str, Any]]) -> Di
         'address': extract_address(latest_cert),
         'latest_epc': extract_latest_epc(latest_cert),
         'epcs': [extract_epc_summary(cert) for cert in certificates],
-        'created_at': datetime.now(timezone.utc).isoformat()
+        'created_at': now_iso or datetime.now(timezone.utc).isoformat()
     }
     
+    g = latest_cert.get
+    
     # Add location geo_point if available
-    if 'location' in latest_cert and latest_cert['location']:
-        property_doc['location'] = latest_cert['location']
+    location = g('location')
+    if location:
+        property_doc['location'] = location
     
     # Calculate estimated running cost from current costs
-    running_costs = [
-        latest_cert.get('HEATING_COST_CURRENT', 0) or 0,
-        latest_cert.get('HOT_WATER_COST_CURRENT', 0) or 0,
-        latest_cert.get('LIGHTING_COST_CURRENT', 0) or 0
-    ]
     try:
-        total_cost = sum(float(c) for c in running_costs if c)
-        if total_cost > 0:
-            property_doc['estimated_running_cost'] = int(total_cost)
+        total_cost = sum(float(c) for c in (g('HEATING_COST_CURRENT'), g('HOT_WATER_COST_CURRENT'),
+                                            g('LIGHTING_COST_CURRENT')) if c)
     except (ValueError, TypeError):
-        pass
+        total_cost = 0
+    if total_cost > 0:
+        property_doc['estimated_running_cost'] = int(total_cost)
     
     return property_doc
 
 
-def fetch_all_certificates_in_batches(client: OpenSearch, cert_index: str) -> Dict[str, List[Dict[str, Any]]]:
+# Certificate fields read by extract_address/extract_latest_epc/extract_epc_summary,
+# build_property_document and the UPRN grouping; iter_certificates_by_uprn fetches only these
+CERTIFICATE_SOURCE_FIELDS = [
+    'UPRN', 'LMK_KEY', 'location',
+    'ADDRESS1', 'ADDRESS2', 'ADDRESS3', 'POSTCODE',
+    'CURRENT_ENERGY_RATING', 'CURRENT_ENERGY_EFFICIENCY',
+    'INSPECTION_DATE', 'LODGEMENT_DATE', 'LODGEMENT_DATETIME',
+    'PROPERTY_TYPE', 'BUILT_FORM', 'CONSTRUCTION_AGE_BAND', 'TOTAL_FLOOR_AREA',
+    'MAINHEAT_DESCRIPTION', 'WALLS_DESCRIPTION', 'ROOF_DESCRIPTION', 'WINDOWS_DESCRIPTION',
+    'MAIN_FUEL', 'WIND_TURBINE_COUNT', 'PHOTO_SUPPLY', 'SOLAR_WATER_HEATING_FLAG',
+    'CO2_EMISSIONS_CURRENT', 'ENERGY_CONSUMPTION_CURRENT',
+    'HEATING_COST_CURRENT', 'HOT_WATER_COST_CURRENT', 'LIGHTING_COST_CURRENT',
+]
+
+
+def _certificate_date(cert: Dict[str, Any]) -> str:
+    """Sort key for a certificate: its lodgement datetime, falling back to older date fields."""
+    return cert.get('LODGEMENT_DATETIME') or cert.get('LODGEMENT_DATE') or cert.get('INSPECTION_DATE') or ''
+
+
+def iter_certificates_by_uprn(
+    client: OpenSearch,
+    cert_index: str,
+    page_size: int = 2000
+) -> Iterator[Tuple[str, List[Dict[str, Any]]]]:
     """
-    Fetch all certificates from the index grouped by UPRN using scroll API.
-    This is much more efficient than querying for each UPRN individually.
+    Stream all certificates from the index grouped by UPRN.
+    
+    Pages through the index sorted by UPRN with search_after, so each
+    property's certificates arrive together and only one property's
+    certificates are held in memory at a time. Unlike a scroll, no search
+    context is kept open on the cluster, so a slow consumer (e.g. bulk
+    indexing backing up) can't make it expire mid-build.
     
     Args:
         client: OpenSearch client
         cert_index: Name of the certificates index
+        page_size: Number of certificates fetched per search request
         
-    Returns:
-        Dictionary mapping UPRN to list of certificate documents (sorted by date, newest first)
+    Yields:
+        (uprn, certificates) tuples, certificates sorted by date (newest first)
     """
-    print('Fetching all certificates using scroll API...')
-    
-    # Determine date field to use for sorting
-    date_fields = ['LODGEMENT_DATETIME', 'LODGEMENT_DATE', 'INSPECTION_DATE']
+    print('Streaming certificates sorted by UPRN...')
     
     body = {
+        'size': page_size,
         'query': {'match_all': {}},
-        'sort': [{'UPRN': 'asc'}, {date_fields[0]: {'order': 'desc', 'missing': '_last'}}],
-        'size': 10000  # Fetch 10k documents per scroll request
+        '_source': CERTIFICATE_SOURCE_FIELDS,
+        # paging stops on a short page, so the total is never needed
+        'track_total_hits': False,
+        'sort': [
+            {'UPRN.keyword': 'asc'},
+            {'LODGEMENT_DATETIME': {'order': 'desc', 'missing': '_last', 'unmapped_type': 'date'}},
+            # unique tiebreaker so no certificate is skipped or repeated between pages
+            {'LMK_KEY.keyword': 'asc'}
+        ]
     }
     
-    # Dictionary to store certificates grouped by UPRN
-    certificates_by_uprn = {}
+    current_uprn = None
+    certificates: List[Dict[str, Any]] = []
     total_certs = 0
     
-    # Initialize scroll
-    response = client.search(index=cert_index, body=body, scroll='5m')
-    scroll_id = response['_scroll_id']
-    
-    # Process first batch
-    hits = response['hits']['hits']
-    while hits:
+    while True:
+        hits = client.search(index=cert_index, body=body)['hits']['hits']
         for hit in hits:
             cert = hit['_source']
             uprn = cert.get('UPRN')
-            if uprn:
-                if uprn not in certificates_by_uprn:
-                    certificates_by_uprn[uprn] = []
-                certificates_by_uprn[uprn].append(cert)
-                total_certs += 1
-        
-        if total_certs % 100000 == 0:
-            print(f'  Processed {total_certs} certificates, {len(certificates_by_uprn)} unique UPRNs...')
-        
-        # Get next batch
-        response = client.scroll(scroll_id=scroll_id, scroll='5m')
-        scroll_id = response['_scroll_id']
-        hits = response['hits']['hits']
-    
-    # Clean up scroll
-    try:
-        client.clear_scroll(scroll_id=scroll_id)
-    except:
-        pass
-    
-    print(f'Fetched {total_certs} certificates for {len(certificates_by_uprn)} unique UPRNs')
-    
-    # Sort certificates within each UPRN by date (newest first)
-    # Already sorted by OpenSearch query, but we may have inserted out of order
-    for uprn, certs in certificates_by_uprn.items():
-        certs.sort(key=lambda c: (
-            c.get('LODGEMENT_DATETIME') or c.get('LODGEMENT_DATE') or c.get('INSPECTION_DATE') or ''
-        ), reverse=True)
-    
-    return certificates_by_uprn
+            if not uprn:
+                continue
+            if uprn != current_uprn:
+                if certificates:
+                    # Not every certificate has LODGEMENT_DATETIME; order by the best available date
+                    certificates.sort(key=_certificate_date, reverse=True)
+                    yield current_uprn, certificates
+                current_uprn = uprn
+                certificates = []
+            certificates.append(cert)
+            total_certs += 1
+            if total_certs % 100000 == 0:
+                print(f'  Processed {total_certs} certificates...')
+        if len(hits) < page_size:
+            break
+        body['search_after'] = hits[-1]['sort']
+    
+    if certificates:
+        certificates.sort(key=_certificate_date, reverse=True)
+        yield current_uprn, certificates
+    
+    print(f'Streamed {total_certs} certificates')
 
 
 def build_properties_index(
     client: OpenSearch,
     cert_index: str,
     prop_index: str,
-    batch_size: int = 500
+    batch_size: int = 500,
+    threads: int = DEFAULT_BULK_THREADS,
+    max_chunk_bytes: int = DEFAULT_MAX_CHUNK_BYTES,
+    replicas: int = 1
 ) -> int:
     """
     Build the properties index from the certificates index.
@@ -337,6 +385,9 @@ def build_properties_index(
         cert_index: Name of the certificates index
         prop_index: Name of the properties index to create
         batch_size: Number of properties to index in each batch
+        threads: Number of threads sending bulk requests in parallel
+        max_chunk_bytes: Maximum size in bytes of a single bulk request
+        replicas: number_of_replicas to set once indexing has finished
         
     Returns:
         Total number of properties indexed
@@ -352,41 +403,50 @@ def build_properties_index(
     client.indices.create(index=prop_index, body=mapping)
     print(f'Created properties index: {prop_index}')
     
-    # Fetch all certificates grouped by UPRN in one efficient operation
-    certificates_by_uprn = fetch_all_certificates_in_batches(client, cert_index)
+    now_iso = datetime.now(timezone.utc).isoformat()
+    
+    def generate_actions():
+        for uprn, certificates in iter_certificates_by_uprn(client, cert_index):
+            prop_doc = build_property_document(uprn, certificates, now_iso)
+            if prop_doc:
+                yield {
+                    '_index': prop_index,
+                    '_id': str(uprn),
+                    '_source': prop_doc
+                }
     
     print(f'Building property documents and indexing in batches...')
     
-    # Process all UPRNs and build property documents
-    actions = []
     total_props = 0
-    
-    for uprn, certificates in certificates_by_uprn.items():
-        # Build property document
-        prop_doc = build_property_document(uprn, certificates)
-        
-        if prop_doc:
-            action = {
-                '_index': prop_index,
-                '_id': str(uprn),
-                '_source': prop_doc
-            }
-            actions.append(action)
-            
-            # Bulk index in batches
-            if len(actions) >= batch_size:
-                helpers.bulk(client, actions)
-                total_props += len(actions)
-                print(f'Indexed {total_props} properties...')
-                actions = []
-    
-    # Index remaining properties
-    if actions:
-        helpers.bulk(client, actions)
-        total_props += len(actions)
-        print(f'Indexed {total_props} properties...')
-    
-    print(f'Properties index build complete: {total_props} documents')
+    failed = 0
+    try:
+        # Property documents are built and indexed as certificates stream in
+        batch_size, actions = tune_chunk_size(generate_actions(), batch_size, max_chunk_bytes)
+        print(f'Using bulk chunk size {batch_size}')
+        for ok, info in helpers.parallel_bulk(
+            client,
+            actions,
+            thread_count=threads,
+            chunk_size=batch_size,
+            max_chunk_bytes=max_chunk_bytes,
+            queue_size=4,
+            raise_on_error=False,
+            request_timeout=120
+        ):
+            if ok:
+                total_props += 1
+                if total_props % batch_size == 0:
+                    print(f'Indexed {total_props} properties...')
+            else:
+                failed += 1
+                print(f'Error indexing property: {info}')
+    except BaseException:
+        # Restore the bulk-load settings even if indexing failed part way
+        restore_after_failed_load(client, prop_index, replicas)
+        raise
+    
+    finish_bulk_load(client, prop_index, replicas=replicas)
+    print(f'Properties index build complete: {total_props} documents ({failed} failed)')
     return total_props
 
 
@@ -426,6 +486,24 @@ def main(argv=None):
         default=500,
         help='Batch size for bulk indexing (default: 500)'
     )
+    parser.add_argument(
+        '--threads',
+        type=int,
+        default=DEFAULT_BULK_THREADS,
+        help='Number of parallel bulk indexing threads (default: CPU count)'
+    )
+    parser.add_argument(
+        '--max-chunk-bytes',
+        type=int,
+        default=DEFAULT_MAX_CHUNK_BYTES,
+        help='Maximum size of a bulk request in bytes (default: 50MB)'
+    )
+    parser.add_argument(
+        '--replicas',
+        type=int,
+        default=1,
+        help='Number of replicas to set once the build finishes (default: 1)'
+    )
     
     args = parser.parse_args(argv)
     
@@ -435,7 +513,13 @@ def main(argv=None):
         http_auth=(args.user, args.password) if args.user else None,
         use_ssl=args.opensearch_url.startswith('https'),
         verify_certs=False,  # Disable for local dev; enable in production
-        ssl_show_warn=False
+        ssl_show_warn=False,
+        serializer=make_serializer(),
+        maxsize=args.threads * 2,  # keep a warm connection for every bulk thread
+        http_compress=True,
+        timeout=120,
+        retry_on_timeout=True,
+        max_retries=5
     )
     
     # Check if certificates index exists
@@ -450,7 +534,10 @@ def main(argv=None):
             client,
             args.cert_index,
             args.prop_index,
-            batch_size=args.batch_size
+            batch_size=args.batch_size,
+            threads=args.threads,
+            max_chunk_bytes=args.max_chunk_bytes,
+            replicas=args.replicas
         )
         return 0
     except Exception as e:
@@ -27,7 +27,7 @@ from typing import Dict, Any, List, Optional
 from opensearchpy import OpenSearch, helpers
 
 # Import enrichment function from ingest_listings
-from ingest_listings import enrich_with_property
+from ingest_listings import enrich_with_property, ensure_derived_fields_mapped
 
 
 def _years_between(start: datetime, end: datetime) -> float:
@@ -437,6 +437,7 @@ def generate_and_index_listings(
         return 0
     
     print(f'Generating listings and indexing into {listings_index}...')
+    ensure_derived_fields_mapped(client, listings_index)
     
     # Generate listings and bulk index
     actions = []
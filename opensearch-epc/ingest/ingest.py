@@ -17,13 +17,51 @@ See README.md for more details.
 """
 import argparse
 import csv
+import itertools
 import json
 import os
+import re
 import sys
 from datetime import datetime
-from typing import Dict, Any, Optional
+from typing import Callable, Dict, Any, Iterable, Iterator, List, Optional, Tuple
 
 from opensearchpy import OpenSearch, helpers
+from opensearchpy.serializer import JSONSerializer
+
+try:
+    import orjson
+except ImportError:  # optional; the client falls back to the stdlib json serializer
+    orjson = None
+
+# EPC rating -> sortable ordinal (A is best). Stored at index time so the API
+# can sort on a numeric doc-values field instead of running a script per hit.
+RATING_ORDINALS = {'A': 1, 'B': 2, 'C': 3, 'D': 4, 'E': 5, 'F': 6, 'G': 7}
+
+# Bulk indexing defaults: one sender thread per core, capped at 50MB a request
+DEFAULT_BULK_THREADS = os.cpu_count() or 4
+DEFAULT_MAX_CHUNK_BYTES = 50 * 1024 * 1024
+CSV_READ_BUFFER = 4 * 1024 * 1024
+
+
+class ORJSONSerializer(JSONSerializer):
+    """Encode bulk request bodies with orjson; responses use the default decoder."""
+
+    def dumps(self, data: Any) -> Any:
+        if isinstance(data, str):
+            return data
+        return orjson.dumps(data, default=self.default).decode('utf-8')
+
+
+def make_serializer() -> JSONSerializer:
+    """Return the orjson serializer if orjson is installed, else the default one."""
+    return ORJSONSerializer() if orjson is not None else JSONSerializer()
+
+
+def rating_ordinal(rating: Any) -> Optional[int]:
+    """Return the 1-7 ordinal for an EPC rating, or None if it isn't A-G."""
+    if not rating:
+        return None
+    return RATING_ORDINALS.get(str(rating).strip().upper())
 
 
 def load_schema(schema_path: str) -> Dict[str, Any]:
@@ -63,6 +101,62 @@ def csvw_type_to_es(dtype: Any) -> Dict[str, Any]:
     return {'type': 'text', 'fields': {'keyword': {'type': 'keyword', 'ignore_above': 256}}}
 
 
+POSTCODE_ANALYSIS = {
+    'char_filter': {
+        'strip_whitespace': {'type': 'pattern_replace', 'pattern': '\\s+', 'replacement': ''},
+    },
+    'normalizer': {
+        'postcode_normalizer': {
+            'type': 'custom',
+            'char_filter': ['strip_whitespace'],
+            'filter': ['uppercase'],
+        },
+    },
+}
+
+
+# Applied when an index is created for a bulk load: no periodic refreshes,
+# no replicas to copy every document to, and fsync the translog in the
+# background. finish_bulk_load puts them back once the load is done.
+BULK_LOAD_SETTINGS = {
+    'refresh_interval': '-1',
+    'number_of_replicas': 0,
+    'translog.durability': 'async',
+}
+
+
+def finish_bulk_load(client: OpenSearch, index_name: str, replicas: int = 1, merge: bool = True):
+    """Restore normal index settings after a bulk load and merge the index down.
+
+    Merging before adding replicas means each replica copies a single
+    segment instead of repeating the merge itself. Pass ``merge=False`` when
+    the load was interrupted: the settings are still restored so the partial
+    index is searchable, but there is no point merging it.
+    """
+    client.indices.refresh(index=index_name)
+    if merge:
+        print(f'Force merging {index_name}...')
+        client.indices.forcemerge(index=index_name, max_num_segments=1, request_timeout=3600)
+    client.indices.put_settings(index=index_name, body={'index': {
+        'refresh_interval': '1s',
+        'number_of_replicas': replicas,
+        'translog.durability': 'request',
+    }})
+
+
+def restore_after_failed_load(client: OpenSearch, index_name: str, replicas: int = 1):
+    """Put back normal settings on an index whose bulk load failed.
+
+    Called while the load's exception is propagating: if the cluster itself
+    is the problem the restore fails too, so report that and let the
+    original error surface rather than replacing it.
+    """
+    try:
+        finish_bulk_load(client, index_name, replicas=replicas, merge=False)
+    except Exception as e:
+        print(f'Could not restore settings on {index_name} after a failed load: {e}')
+
+
 def build_mapping_from_schema(schema: Dict[str, Any]) -> Dict[str, Any]:
     props = {}
     for name, dtype in schema['columns'].items():
@@ -71,13 +165,33 @@ def build_mapping_from_schema(schema: Dict[str, Any]) -> Dict[str, Any]:
         props[fld] = csvw_type_to_es(dtype)
     # add a location geo_point if later provided
     props['location'] = {'type': 'geo_point'}
-    mapping = {'mappings': {'properties': props}}
+    # derived fields computed at ingest (see add_derived_fields)
+    props['current_energy_rating_ord'] = {'type': 'byte'}
+    props['running_cost_monthly'] = {'type': 'double'}
+    # normalize postcodes so "hp13 3hh", "HP133HH" and "HP13 3HH" index (and query) as one term
+    postcode_keyword = props.get('POSTCODE', {}).get('fields', {}).get('keyword')
+    if postcode_keyword is not None:
+        postcode_keyword['normalizer'] = 'postcode_normalizer'
+    mapping = {
+        'settings': {'index': dict(BULK_LOAD_SETTINGS), 'analysis': POSTCODE_ANALYSIS},
+        'mappings': {'properties': props},
+    }
     return mapping
 
 
-def parse_value(val: str, dtype: Any):
-    if val is None or val == '':
-        return None
+# The date formats found in the CSVs: 'YYYY-MM-DD HH:MM:SS', 'YYYY-MM-DD' and
+# 'YYYY/MM/DD' (strptime also accepted unpadded fields, so this does too).
+# One match plus a datetime() range check replaces trying each format in
+# turn with strptime.
+_DATE_RE = re.compile(r'(\d{4})-(\d{1,2})-(\d{1,2})(?: (\d{1,2}):(\d{1,2}):(\d{1,2}))?|(\d{4})/(\d{1,2})/(\d{1,2})')
+
+
+def make_parser(dtype: Any) -> Callable[[Optional[str]], Any]:
+    """Return a function that parses one CSV cell of the given CSVW type.
+
+    The type is resolved once here so the per-cell call does no dispatch.
+    Empty cells parse to None; values that fail to parse are kept as strings.
+    """
     if isinstance(dtype, dict):
         base = dtype.get('base') or dtype.get('datatype')
     else:
@@ -85,75 +199,157 @@ def parse_value(val: str, dtype: Any):
     if base is None:
         base = 'string'
     base = str(base).lower()
-    try:
-        if base in ('integer', 'int'):
-            return int(val)
-        if base in ('float', 'double', 'decimal'):
-            return float(val)
-        if 'date' in base or 'datetime' in base:
-            # try common formats
-            for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d', '%Y/%m/%d'):
-                try:
-                    dt = datetime.strptime(val, fmt)
-                    return dt.isoformat()
-                except Exception:
-                    continue
-            return val
-    except Exception:
+
+    convert = None
+    if base in ('integer', 'int'):
+        convert = int
+    elif base in ('float', 'double', 'decimal'):
+        convert = float
+
+    if convert is not None:
+        def parse_number(val):
+            if val is None or val == '':
+                return None
+            try:
+                return convert(val)
+            except ValueError:
+                return val
+        return parse_number
+
+    if 'date' in base or 'datetime' in base:
+        def parse_date(val):
+            if val is None or val == '':
+                return None
+            m = _DATE_RE.fullmatch(val)
+            if m is None:
+                return val
+            try:
+                return datetime(*[int(g) for g in m.groups() if g is not None]).isoformat()
+            except ValueError:  # e.g. month 13 or 30 February
+                return val
+        return parse_date
+
+    def parse_string(val):
+        if val is None or val == '':
+            return None
         return val
-    return val
+    return parse_string
+
+
+def parse_value(val: str, dtype: Any):
+    return make_parser(dtype)(val)
+
 
+def add_derived_fields(doc: Dict[str, Any]) -> Dict[str, Any]:
+    """Add fields computed from the raw CSV columns, used for sorting by the API."""
+    doc['current_energy_rating_ord'] = rating_ordinal(doc.get('CURRENT_ENERGY_RATING'))
+    # Same formula as api/running_cost.py:calculate_running_cost
+    heating = doc.get('HEATING_COST_CURRENT')
+    hot_water = doc.get('HOT_WATER_COST_CURRENT')
+    if isinstance(heating, (int, float)) and isinstance(hot_water, (int, float)):
+        doc['running_cost_monthly'] = heating + hot_water
+    else:
+        doc['running_cost_monthly'] = None
+    return doc
 
-def ingest_certificates(client: OpenSearch, csv_path: str, schema: Dict[str, Any], index_name: str, batch_size: int = 1000):
+
+def gen_actions(rows: Iterable[List[str]], schema: Dict[str, Any], index_name: str) -> Iterator[Dict[str, Any]]:
+    """Yield one bulk index action per CSV row, keyed by LMK_KEY when present.
+
+    ``rows`` is a ``csv.reader``: the first row is the header, the rest are
+    data rows. Columns are read by position, so no per-row dict is built.
+    Schema columns missing from the header (or from a short row) are None.
+    """
+    rows = iter(rows)
+    header = next(rows, None)
+    if header is None:
+        return
+    positions = {name: i for i, name in enumerate(header)}
+    columns = tuple(
+        (col, positions.get(col), make_parser(dtype))
+        for col, dtype in schema['columns'].items()
+    )
+    for row in rows:
+        width = len(row)
+        doc: Dict[str, Any] = {}
+        for col, i, parse in columns:
+            doc[col] = parse(row[i]) if i is not None and i < width else None
+        add_derived_fields(doc)
+        action = {'_index': index_name, '_source': doc}
+        if doc.get('LMK_KEY'):
+            action['_id'] = str(doc['LMK_KEY'])
+        yield action
+
+
+def tune_chunk_size(actions: Iterator[Dict[str, Any]], chunk_size: int, max_chunk_bytes: int,
+                    sample_size: int = 100) -> Tuple[int, Iterator[Dict[str, Any]]]:
+    """Cap chunk_size so an average chunk fits in max_chunk_bytes.
+
+    Serializes the first ``sample_size`` documents to estimate their average
+    size. Returns the chunk size to use and an iterator that still yields
+    every action, including the sampled ones.
+    """
+    head = list(itertools.islice(actions, sample_size))
+    if head:
+        avg_doc_size = sum(len(json.dumps(a['_source'], default=str)) for a in head) / len(head)
+        chunk_size = max(1, min(chunk_size, int(max_chunk_bytes // avg_doc_size)))
+    return chunk_size, itertools.chain(head, actions)
+
+
+def ingest_certificates(client: OpenSearch, csv_path: str, schema: Dict[str, Any], index_name: str, batch_size: int = 1000,
+                        threads: int = DEFAULT_BULK_THREADS, max_chunk_bytes: int = DEFAULT_MAX_CHUNK_BYTES,
+                        replicas: int = 1, recreate: bool = False):
     # create index with mapping
     mapping = build_mapping_from_schema(schema)
-    if client.indices.exists(index=index_name):
+    created = False
+    exists = client.indices.exists(index=index_name)
+    if exists and recreate:
+        # Mapping and analysis changes (e.g. the postcode normalizer) only take
+        # effect on a new index, so drop the old one and load from scratch
+        print(f'Deleting existing index {index_name}')
+        client.indices.delete(index=index_name)
+        exists = False
+    if exists:
         print(f'Index {index_name} already exists')
     else:
         client.indices.create(index=index_name, body=mapping)
+        created = True
         print(f'Created index {index_name}')
 
-    actions = []
     total = 0
-    processed = 0
-    
-    with open(csv_path, newline='', encoding='utf-8') as fh:
-        reader = csv.DictReader(fh)
-        for row in reader:
-            processed += 1
-            doc: Dict[str, Any] = {}
-            for col, dtype in schema['columns'].items():
-                raw = row.get(col)
-                doc[col] = parse_value(raw, dtype)    
-            # determine id: use LMK_KEY (primary) if present
-            doc_id = None
-            if 'LMK_KEY' in doc and doc['LMK_KEY']:
-                doc_id = str(doc['LMK_KEY'])
-            action = {'_index': index_name, '_source': doc}
-            if doc_id:
-                action['_id'] = doc_id
-            actions.append(action)
-            
-            if len(actions) >= batch_size:
-                try:
-                    helpers.bulk(client, actions, chunk_size=batch_size, max_retries=3, request_timeout=60)
-                    total += len(actions)
-                    print(f'Indexed {total} certificates... (processed {processed} rows)')
-                    actions.clear()  # Explicit clear for memory
-                except Exception as e:
-                    print(f'Error indexing batch: {e}')
-                    # Continue with next batch
-                    actions.clear()
-                    
-    if actions:
-        try:
-            helpers.bulk(client, actions, chunk_size=batch_size, max_retries=3, request_timeout=60)
-            total += len(actions)
-            print(f'Indexed {total} certificates (final, processed {processed} rows)')
-        except Exception as e:
-            print(f'Error indexing final batch: {e}')
-        finally:
-            actions.clear()
+    failed = 0
+
+    try:
+        # A large read buffer means far fewer read() syscalls on a multi-GB CSV
+        with open(csv_path, newline='', encoding='utf-8', buffering=CSV_READ_BUFFER) as fh:
+            reader = csv.reader(fh)
+            batch_size, actions = tune_chunk_size(gen_actions(reader, schema, index_name), batch_size, max_chunk_bytes)
+            print(f'Using bulk chunk size {batch_size}')
+
+            # Rows are parsed lazily and sent by several threads at once, so the
+            # client keeps the cluster busy instead of waiting on each batch
+            for ok, info in helpers.parallel_bulk(client, actions, thread_count=threads,
+                                                  chunk_size=batch_size, max_chunk_bytes=max_chunk_bytes,
+                                                  queue_size=4, raise_on_error=False, request_timeout=120):
+                if ok:
+                    total += 1
+                    if total % batch_size == 0:
+                        print(f'Indexed {total} certificates...')
+                else:
+                    failed += 1
+                    print(f'Error indexing document: {info}')
+    except BaseException:
+        # Restore the bulk-load settings even if the load failed part way, or a
+        # rerun would find the index, leave it alone and it would never refresh
+        if created:
+            restore_after_failed_load(client, index_name, replicas)
+        raise
+
+    # An existing index keeps whatever settings it already had
+    if created:
+        finish_bulk_load(client, index_name, replicas=replicas)
+
+    print(f'Indexed {total} certificates (final, {failed} failed)')
 
 
 def main(argv=None):
@@ -165,15 +361,26 @@ def main(argv=None):
     p.add_argument('--password', default=os.environ.get('OPENSEARCH_PASS'))
     p.add_argument('--index', default='certificates')
     p.add_argument('--batch-size', type=int, default=5000)
+    p.add_argument('--threads', type=int, default=DEFAULT_BULK_THREADS, help='parallel bulk request threads')
+    p.add_argument('--max-chunk-bytes', type=int, default=DEFAULT_MAX_CHUNK_BYTES, help='max size of one bulk request')
+    p.add_argument('--replicas', type=int, default=1, help='number_of_replicas to set once the load finishes')
+    p.add_argument('--recreate', action='store_true',
+                   help='delete and recreate the index if it exists (needed to pick up mapping changes)')
     args = p.parse_args(argv)
 
     schema_path = os.path.join(os.path.dirname(__file__), args.schema) if not os.path.isabs(args.schema) else args.schema
     csv_path = os.path.join(os.path.dirname(__file__), args.csv) if not os.path.isabs(args.csv) else args.csv
     schema = load_schema(schema_path)
 
-    client = OpenSearch([args.opensearch_url], http_auth=(args.user, args.password) if args.user else None)
+    # One pooled connection per bulk thread (plus headroom) so parallel_bulk never
+    # waits on a new TCP/TLS handshake; gzip the large bulk bodies
+    client = OpenSearch([args.opensearch_url], http_auth=(args.user, args.password) if args.user else None,
+                        serializer=make_serializer(), maxsize=args.threads * 2, http_compress=True, timeout=120,
+                        retry_on_timeout=True, max_retries=5)
 
-    ingest_certificates(client, csv_path, schema, args.index, batch_size=args.batch_size)
+    ingest_certificates(client, csv_path, schema, args.index, batch_size=args.batch_size,
+                        threads=args.threads, max_chunk_bytes=args.max_chunk_bytes,
+                        replicas=args.replicas, recreate=args.recreate)
 
 
 if __name__ == '__main__':
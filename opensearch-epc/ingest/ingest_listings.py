@@ -25,6 +25,8 @@ from typing import Dict, Any, Iterable, Optional, List
 
 from opensearchpy import OpenSearch, helpers
 
+from ingest import rating_ordinal
+
 
 def iter_listings() -> Iterable[Dict[str, Any]]:
     """Yield raw listing docs from your source system.
@@ -90,15 +92,37 @@ def enrich_with_property(listing: Dict[str, Any], prop: Optional[Dict[str, Any]]
         if "location" not in out and prop.get("location"):
             out["location"] = prop["location"]
 
+    # Numeric rating ordinal so searches can sort on doc values
+    if out.get("epc_rating"):
+        out.setdefault("epc_rating_ord", rating_ordinal(out["epc_rating"]))
+
     return out
 
 
+# Fields computed by enrich_with_property that older listings indices may lack
+DERIVED_LISTING_FIELDS = {"epc_rating_ord": {"type": "byte"}}
+
+
+def ensure_derived_fields_mapped(client: OpenSearch, listings_index: str) -> None:
+    """Add derived fields to an existing listings index's mapping.
+
+    listings-v1 is ``"dynamic": "strict"``, so an index created before a
+    derived field existed rejects every document carrying it. Adding a new
+    field with put_mapping is allowed on a live index (and a no-op when it is
+    already mapped); a missing index is left to be created from the mapping.
+    """
+    if client.indices.exists(index=listings_index):
+        client.indices.put_mapping(index=listings_index, body={"properties": DERIVED_LISTING_FIELDS})
+
+
 def upsert_listings(
     client: OpenSearch,
     listings_index: str,
     properties_index: str,
     batch_size: int = 500,
 ) -> int:
+    ensure_derived_fields_mapped(client, listings_index)
+
     actions: List[Dict[str, Any]] = []
     total = 0
 
@@ -17,12 +17,13 @@ from datetime import datetime
 from typing import Dict, Any
 
 from build_property_index import (
+    CERTIFICATE_SOURCE_FIELDS,
     create_property_mapping,
     extract_address,
     extract_latest_epc,
     extract_epc_summary,
     build_property_document,
-    fetch_all_certificates_by_uprn,
+    iter_certificates_by_uprn,
     build_properties_index,
     main
 )
@@ -357,6 +358,12 @@ class TestPropertyDocumentBuilding:
         prop_doc = build_property_document('12345', [])
         assert prop_doc is None
     
+    def test_build_property_document_uses_given_timestamp(self):
+        """Test that a caller-supplied created_at timestamp is used as-is."""
+        now_iso = '2025-01-01T00:00:00+00:00'
+        prop_doc = build_property_document('12345', [{'LMK_KEY': 'cert1'}], now_iso)
+        assert prop_doc['created_at'] == now_iso
+    
     def test_build_property_document_with_location(self):
         """Test building property document with geo location."""
         cert = {
@@ -374,85 +381,124 @@ class TestPropertyDocumentBuilding:
         assert prop_doc['location'] == {'lat': 51.5, 'lon': -0.1}
 
 
+class _RecordingCert(dict):
+    """Certificate dict that records every field read from it."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.read = set()
+
+    def get(self, key, default=None):
+        self.read.add(key)
+        return super().get(key, default)
+
+    def __contains__(self, key):
+        self.read.add(key)
+        return super().__contains__(key)
+
+    def __getitem__(self, key):
+        self.read.add(key)
+        return super().__getitem__(key)
+
+
 class TestFetchCertificates:
-    """Test fetching certificates from OpenSearch."""
+    """Test streaming certificates from OpenSearch."""
     
-    def test_fetch_all_certificates_by_uprn(self):
-        """Test fetching all certificates for a UPRN."""
+    def test_iter_certificates_by_uprn_groups_sorted_stream(self):
+        """Test that sorted search_after pages are grouped into per-UPRN certificate lists."""
         mock_client = unittest.mock.Mock()
-        
-        # Mock search response
-        mock_response = {
-            'hits': {
-                'hits': [
-                    {'_source': {'LMK_KEY': 'cert1', 'LODGEMENT_DATE': '2024-01-01'}},
-                    {'_source': {'LMK_KEY': 'cert2', 'LODGEMENT_DATE': '2023-01-01'}}
-                ]
-            }
-        }
-        mock_client.search.return_value = mock_response
-        
-        certs = fetch_all_certificates_by_uprn(mock_client, 'test-index', '12345')
-        
-        # Check search was called with correct parameters
-        mock_client.search.assert_called_once()
-        call_args = mock_client.search.call_args
-        assert call_args[1]['index'] == 'test-index'
-        assert call_args[1]['body']['query']['term']['UPRN.keyword'] == '12345'
-        
-        # Check returned certificates
-        assert len(certs) == 2
-        assert certs[0]['LMK_KEY'] == 'cert1'
-        assert certs[1]['LMK_KEY'] == 'cert2'
+        pages = [
+            [
+                {'_source': {'UPRN': '12345', 'LMK_KEY': 'cert1', 'LODGEMENT_DATE': '2023-01-01'}, 'sort': ['12345', 1, 'cert1']},
+                {'_source': {'UPRN': '12345', 'LMK_KEY': 'cert2', 'LODGEMENT_DATE': '2024-01-01'}, 'sort': ['12345', 2, 'cert2']},
+            ],
+            [
+                {'_source': {'UPRN': '67890', 'LMK_KEY': 'cert3', 'LODGEMENT_DATE': '2022-01-01'}, 'sort': ['67890', 3, 'cert3']},
+                {'_source': {'LMK_KEY': 'no-uprn'}, 'sort': [None, 4, 'no-uprn']},
+            ],
+            [],
+        ]
+        bodies = []
+        
+        def search(index, body):
+            bodies.append(dict(body))
+            return {'hits': {'hits': pages[len(bodies) - 1]}}
+        
+        mock_client.search.side_effect = search
+        
+        groups = list(iter_certificates_by_uprn(mock_client, 'test-index', page_size=2))
+        
+        # Pages through the whole index sorted so each UPRN's certificates are adjacent
+        assert mock_client.search.call_count == 3
+        assert mock_client.search.call_args[1]['index'] == 'test-index'
+        assert bodies[0]['sort'][0] == {'UPRN.keyword': 'asc'}
+        assert bodies[0]['_source'] == CERTIFICATE_SOURCE_FIELDS
+        assert bodies[0]['track_total_hits'] is False
+        assert 'search_after' not in bodies[0]
+        assert bodies[1]['search_after'] == ['12345', 2, 'cert2']
+        assert bodies[2]['search_after'] == [None, 4, 'no-uprn']
+        
+        # Grouped by UPRN, newest first, certificates without a UPRN skipped
+        assert [uprn for uprn, _ in groups] == ['12345', '67890']
+        assert [c['LMK_KEY'] for c in groups[0][1]] == ['cert2', 'cert1']
+        assert [c['LMK_KEY'] for c in groups[1][1]] == ['cert3']
+    
+    def test_source_fields_cover_property_document(self):
+        """Every certificate field the property document reads is fetched by the certificate search."""
+        cert = _RecordingCert(location='51.5,-0.1')
+        build_property_document('12345', [cert])
+        assert cert.read <= set(CERTIFICATE_SOURCE_FIELDS)
+
+
+def _index_all(client, actions, **kwargs):
+    """Stand-in for helpers.parallel_bulk that reports every action as indexed."""
+    return ((True, {'index': action}) for action in actions)
 
 
 class TestBuildPropertiesIndex:
     """Test the main properties index building function."""
     
-    @unittest.mock.patch('build_property_index.fetch_all_certificates_by_uprn')
+    @unittest.mock.patch('build_property_index.iter_certificates_by_uprn')
     @unittest.mock.patch('build_property_index.helpers')
-    def test_build_properties_index(self, mock_helpers, mock_fetch):
+    def test_build_properties_index(self, mock_helpers, mock_iter):
         """Test building the properties index."""
         mock_client = unittest.mock.Mock()
         mock_client.indices.exists.return_value = False
         mock_client.indices.create.return_value = {'acknowledged': True}
         
-        # Mock composite aggregation response
-        mock_search_response = {
-            'aggregations': {
-                'by_uprn': {
-                    'buckets': [
-                        {'key': {'uprn': '12345'}},
-                        {'key': {'uprn': '67890'}}
-                    ],
-                    'after_key': None  # No more pages
-                }
-            }
-        }
-        mock_client.search.return_value = mock_search_response
-        
-        # Mock fetching certificates
-        mock_fetch.side_effect = [
-            [{'LMK_KEY': 'cert1', 'ADDRESS1': 'Test St', 'CURRENT_ENERGY_RATING': 'B', 
-              'CURRENT_ENERGY_EFFICIENCY': 85}],
-            [{'LMK_KEY': 'cert2', 'ADDRESS1': 'Demo Ave', 'CURRENT_ENERGY_RATING': 'C',
-              'CURRENT_ENERGY_EFFICIENCY': 70}]
-        ]
+        # Mock streamed certificate groups
+        mock_iter.return_value = iter([
+            ('12345', [{'LMK_KEY': 'cert1', 'ADDRESS1': 'Test St', 'CURRENT_ENERGY_RATING': 'B',
+                        'CURRENT_ENERGY_EFFICIENCY': 85}]),
+            ('67890', [{'LMK_KEY': 'cert2', 'ADDRESS1': 'Demo Ave', 'CURRENT_ENERGY_RATING': 'C',
+                        'CURRENT_ENERGY_EFFICIENCY': 70}])
+        ])
+        mock_helpers.parallel_bulk.side_effect = _index_all
         
         total = build_properties_index(mock_client, 'test-certs', 'test-props', batch_size=10)
         
         # Verify index creation
         mock_client.indices.create.assert_called_once()
         
-        # Verify bulk indexing was called
-        assert mock_helpers.bulk.call_count >= 1
+        # Verify bulk indexing was called with the configured chunk size
+        mock_helpers.parallel_bulk.assert_called_once()
+        assert mock_helpers.parallel_bulk.call_args[1]['chunk_size'] == 10
         
         # Verify total count
         assert total == 2
+        
+        # Verify the index is created for bulk loading and restored afterwards
+        create_body = mock_client.indices.create.call_args[1]['body']
+        assert create_body['settings']['index']['refresh_interval'] == '-1'
+        mock_client.indices.forcemerge.assert_called_once_with(
+            index='test-props', max_num_segments=1, request_timeout=3600)
+        restored = mock_client.indices.put_settings.call_args[1]['body']['index']
+        assert restored['refresh_interval'] == '1s'
+        assert restored['number_of_replicas'] == 1
     
-    @unittest.mock.patch('build_property_index.fetch_all_certificates_by_uprn')
+    @unittest.mock.patch('build_property_index.iter_certificates_by_uprn')
     @unittest.mock.patch('build_property_index.helpers')
-    def test_build_properties_index_recreates_existing(self, mock_helpers, mock_fetch):
+    def test_build_properties_index_recreates_existing(self, mock_helpers, mock_iter):
         """Test that existing index is deleted and recreated."""
         mock_client = unittest.mock.Mock()
         mock_client.indices.exists.return_value = True
@@ -460,15 +506,45 @@ class TestBuildPropertiesIndex:
         mock_client.indices.create.return_value = {'acknowledged': True}
         
         # Mock empty results
-        mock_client.search.return_value = {
-            'aggregations': {'by_uprn': {'buckets': [], 'after_key': None}}
-        }
+        mock_iter.return_value = iter([])
+        mock_helpers.parallel_bulk.side_effect = _index_all
         
         build_properties_index(mock_client, 'test-certs', 'test-props')
         
         # Verify deletion and recreation
         mock_client.indices.delete.assert_called_once_with(index='test-props')
         mock_client.indices.create.assert_called_once()
+    
+    @unittest.mock.patch('build_property_index.iter_certificates_by_uprn')
+    @unittest.mock.patch('build_property_index.helpers')
+    def test_build_properties_index_restores_settings_on_failure(self, mock_helpers, mock_iter):
+        """Test that an interrupted build still restores the bulk-load settings."""
+        mock_client = unittest.mock.Mock()
+        mock_client.indices.exists.return_value = False
+        mock_iter.return_value = iter([])
+        mock_helpers.parallel_bulk.side_effect = ConnectionError('cluster went away')
+        
+        with pytest.raises(ConnectionError):
+            build_properties_index(mock_client, 'test-certs', 'test-props')
+        
+        restored = mock_client.indices.put_settings.call_args[1]['body']['index']
+        assert restored['refresh_interval'] == '1s'
+        mock_client.indices.forcemerge.assert_not_called()
+    
+    @unittest.mock.patch('build_property_index.iter_certificates_by_uprn')
+    @unittest.mock.patch('build_property_index.helpers')
+    def test_build_properties_index_failed_restore_keeps_build_error(self, mock_helpers, mock_iter):
+        """Test that a restore failing as well does not hide why the build failed."""
+        mock_client = unittest.mock.Mock()
+        mock_client.indices.exists.return_value = False
+        mock_iter.return_value = iter([])
+        mock_helpers.parallel_bulk.side_effect = ConnectionError('cluster went away')
+        mock_client.indices.put_settings.side_effect = TimeoutError('settings timed out')
+        
+        with pytest.raises(ConnectionError, match='cluster went away'):
+            build_properties_index(mock_client, 'test-certs', 'test-props')
+        
+        mock_client.indices.put_settings.assert_called_once()
 
 
 class TestMainFunction:
@@ -10,12 +10,14 @@ This test suite covers:
 """
 
 import pytest
+import unittest.mock
 from datetime import datetime, timezone
 
 from generate_dummy_listings import (
     estimate_price_from_property,
     estimate_bedrooms,
     generate_listing_from_property,
+    generate_and_index_listings,
 )
 
 
@@ -270,3 +272,20 @@ class TestListingGeneration:
 
 if __name__ == '__main__':
     pytest.main([__file__, '-v'])
+
+
+class TestIndexListings:
+    """Test indexing generated listings."""
+    
+    @unittest.mock.patch('generate_dummy_listings.helpers')
+    @unittest.mock.patch('generate_dummy_listings.sample_properties_for_listings')
+    def test_derived_fields_mapped_on_existing_index(self, mock_sample, mock_helpers):
+        """Test that epc_rating_ord is added to an existing strict listings index first."""
+        mock_client = unittest.mock.MagicMock()
+        mock_client.indices.exists.return_value = True
+        mock_sample.return_value = [{'uprn': '12345', 'latest_epc': {'rating': 'C'}}]
+        
+        generate_and_index_listings(mock_client, 'properties', 'listings-v1')
+        
+        mock_client.indices.put_mapping.assert_called_once_with(
+            index='listings-v1', body={'properties': {'epc_rating_ord': {'type': 'byte'}}})
@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 """
-Tests for ingest_domestic_2023.py
+Tests for ingest.py
 
 This test suite covers:
 - Schema loading and parsing
@@ -20,11 +20,18 @@ from datetime import datetime
 from pathlib import Path
 
 # Import the functions we want to test
-from ingest_domestic_2023 import (
+from ingest import (
     load_schema,
     csvw_type_to_es,
     build_mapping_from_schema,
     parse_value,
+    make_parser,
+    rating_ordinal,
+    add_derived_fields,
+    gen_actions,
+    tune_chunk_size,
+    make_serializer,
+    ORJSONSerializer,
     ingest_certificates,
     main
 )
@@ -146,6 +153,19 @@ class TestMappingGeneration:
         assert props['TOTAL_FLOOR_AREA']['type'] == 'double'
         assert props['INSPECTION_DATE']['type'] == 'date'
         assert props['location']['type'] == 'geo_point'
+        assert props['current_energy_rating_ord']['type'] == 'byte'
+        assert props['running_cost_monthly']['type'] == 'double'
+
+    def test_postcode_keyword_uses_normalizer(self):
+        """Test that POSTCODE.keyword is normalized and the normalizer is defined."""
+        schema = {'columns': {'LMK_KEY': 'string', 'POSTCODE': 'string'}, 'primaryKey': 'LMK_KEY'}
+
+        mapping = build_mapping_from_schema(schema)
+
+        keyword = mapping['mappings']['properties']['POSTCODE']['fields']['keyword']
+        assert keyword['normalizer'] == 'postcode_normalizer'
+        assert 'postcode_normalizer' in mapping['settings']['analysis']['normalizer']
+        assert 'normalizer' not in mapping['mappings']['properties']['LMK_KEY']['fields']['keyword']
 
 
 class TestValueParsing:
@@ -173,6 +193,11 @@ class TestValueParsing:
         # Invalid float should return original string
         assert parse_value('not_a_number', 'float') == 'not_a_number'
     
+    def test_make_parser_reuses_resolved_type(self):
+        """A parser built once from a CSVW type object handles every cell."""
+        parse = make_parser({'base': 'integer'})
+        assert [parse(v) for v in ('1', '', None, 'x')] == [1, None, None, 'x']
+    
     def test_parse_value_date(self):
         """Test parsing date values."""
         # Test various date formats
@@ -187,6 +212,9 @@ class TestValueParsing:
         assert parse_value('', 'date') is None
         # Invalid date should return original string
         assert parse_value('invalid_date', 'date') == 'invalid_date'
+        assert parse_value('2023-02-30', 'date') == '2023-02-30'
+        assert parse_value('2023/01/15', 'date') == '2023-01-15T00:00:00'
+        assert parse_value('2023-01-15 10:30:00', 'date') == '2023-01-15T10:30:00'
     
     def test_parse_value_dict_dtype(self):
         """Test parsing with dict-format datatype."""
@@ -197,13 +225,117 @@ class TestValueParsing:
         assert parse_value('123.45', dtype) == 123.45
 
 
+class TestDerivedFields:
+    """Test fields computed at ingest time."""
+    
+    def test_rating_ordinal(self):
+        """Test EPC ratings map to 1-7 ordinals."""
+        assert rating_ordinal('A') == 1
+        assert rating_ordinal('G') == 7
+        assert rating_ordinal(' c ') == 3
+        assert rating_ordinal('Z') is None
+        assert rating_ordinal('') is None
+        assert rating_ordinal(None) is None
+    
+    def test_add_derived_fields(self):
+        """Test derived fields are added to the document."""
+        doc = add_derived_fields({'CURRENT_ENERGY_RATING': 'B'})
+        assert doc['current_energy_rating_ord'] == 2
+        
+        doc = add_derived_fields({})
+        assert doc['current_energy_rating_ord'] is None
+        assert doc['running_cost_monthly'] is None
+    
+    def test_add_derived_fields_running_cost(self):
+        """Test running cost is the sum of heating and hot water costs."""
+        doc = add_derived_fields({'HEATING_COST_CURRENT': 80, 'HOT_WATER_COST_CURRENT': 20.5})
+        assert doc['running_cost_monthly'] == 100.5
+        
+        doc = add_derived_fields({'HEATING_COST_CURRENT': 80})
+        assert doc['running_cost_monthly'] is None
+
+
+class TestGenActions:
+    """Test the lazy CSV row -> bulk action generator."""
+
+    def test_gen_actions_yields_parsed_documents(self):
+        """Each row becomes one action with typed values and an LMK_KEY id."""
+        schema = {'columns': {'LMK_KEY': 'string', 'TOTAL_FLOOR_AREA': 'decimal'}}
+        rows = iter([
+            ['TOTAL_FLOOR_AREA', 'LMK_KEY'],
+            ['100.5', '123'],
+            ['', ''],
+        ])
+
+        actions = gen_actions(rows, schema, 'certs')
+        first = next(actions)
+        assert first['_index'] == 'certs'
+        assert first['_id'] == '123'
+        assert first['_source']['TOTAL_FLOOR_AREA'] == 100.5
+        assert 'current_energy_rating_ord' in first['_source']
+
+        second = next(actions)
+        assert '_id' not in second
+        assert second['_source']['TOTAL_FLOOR_AREA'] is None
+
+    def test_gen_actions_missing_columns_are_none(self):
+        """Columns absent from the header or a short row parse as None."""
+        schema = {'columns': {'LMK_KEY': 'string', 'ADDRESS': 'string', 'POSTCODE': 'string'}}
+        rows = [['LMK_KEY', 'ADDRESS'], ['123']]
+
+        [action] = list(gen_actions(rows, schema, 'certs'))
+        assert action['_source']['LMK_KEY'] == '123'
+        assert action['_source']['ADDRESS'] is None
+        assert action['_source']['POSTCODE'] is None
+
+
+class TestTuneChunkSize:
+    """Test sizing bulk chunks from sampled documents."""
+
+    def test_chunk_size_capped_by_document_size(self):
+        """Large documents shrink the chunk; every action is still yielded."""
+        actions = iter([{'_source': {'text': 'x' * 988}} for _ in range(5)])
+        chunk_size, replay = tune_chunk_size(actions, 5000, 10_000, sample_size=2)
+        assert chunk_size == 10
+        assert len(list(replay)) == 5
+
+    def test_chunk_size_kept_for_small_documents(self):
+        """The requested chunk size is an upper bound."""
+        chunk_size, replay = tune_chunk_size(iter([{'_source': {}}]), 500, 50 * 1024 * 1024)
+        assert chunk_size == 500
+        assert list(replay) == [{'_source': {}}]
+
+
+class TestSerializer:
+    """Test the client serializer used for bulk bodies."""
+
+    def test_orjson_serializer_round_trip(self):
+        """orjson output decodes back to the same document."""
+        pytest.importorskip('orjson')
+        serializer = make_serializer()
+        assert isinstance(serializer, ORJSONSerializer)
+        doc = {'LMK_KEY': '123', 'TOTAL_FLOOR_AREA': 100.5, 'ADDRESS': 'Flat 1, Caf\u00e9 Row'}
+        encoded = serializer.dumps(doc)
+        assert isinstance(encoded, str)
+        assert serializer.loads(encoded) == doc
+        assert serializer.dumps('{"pre": "encoded"}') == '{"pre": "encoded"}'
+
+
 class TestIngestCertificates:
     """Test the main ingestion function."""
     
-    @unittest.mock.patch('ingest_domestic_2023.helpers')
+    @unittest.mock.patch('ingest.helpers')
     @unittest.mock.patch('builtins.open')
     def test_ingest_certificates_basic(self, mock_open, mock_helpers):
         """Test basic certificate ingestion."""
+        indexed = []
+
+        def index_all(client, actions, **kwargs):
+            for action in actions:
+                indexed.append(action['_id'])
+                yield True, {'index': action}
+
+        mock_helpers.parallel_bulk.side_effect = index_all
         # Mock OpenSearch client
         mock_client = unittest.mock.MagicMock()
         mock_client.indices.exists.return_value = False
@@ -211,15 +343,16 @@ class TestIngestCertificates:
         
         # Mock CSV data
         csv_data = [
-            {'LMK_KEY': '123', 'ADDRESS': '123 Test St', 'TOTAL_FLOOR_AREA': '100.5'},
-            {'LMK_KEY': '456', 'ADDRESS': '456 Demo Ave', 'TOTAL_FLOOR_AREA': '75.0'}
+            ['LMK_KEY', 'ADDRESS', 'TOTAL_FLOOR_AREA'],
+            ['123', '123 Test St', '100.5'],
+            ['456', '456 Demo Ave', '75.0']
         ]
         
-        # Mock csv.DictReader
+        # Mock csv.reader
         mock_reader = unittest.mock.MagicMock()
         mock_reader.__iter__ = unittest.mock.MagicMock(return_value=iter(csv_data))
         
-        with unittest.mock.patch('csv.DictReader', return_value=mock_reader):
+        with unittest.mock.patch('csv.reader', return_value=mock_reader):
             schema = {
                 'columns': {
                     'LMK_KEY': 'string',
@@ -235,10 +368,11 @@ class TestIngestCertificates:
             mock_client.indices.exists.assert_called_once_with(index='test-index')
             mock_client.indices.create.assert_called_once()
             
-            # Verify bulk operations were called
-            assert mock_helpers.bulk.call_count >= 1
+            # Verify every row reached parallel_bulk
+            mock_helpers.parallel_bulk.assert_called_once()
+            assert indexed == ['123', '456']
     
-    @unittest.mock.patch('ingest_domestic_2023.helpers')
+    @unittest.mock.patch('ingest.helpers')
     @unittest.mock.patch('builtins.open')
     def test_ingest_certificates_existing_index(self, mock_open, mock_helpers):
         """Test ingestion when index already exists."""
@@ -250,7 +384,7 @@ class TestIngestCertificates:
         mock_reader = unittest.mock.MagicMock()
         mock_reader.__iter__ = unittest.mock.MagicMock(return_value=iter([]))
         
-        with unittest.mock.patch('csv.DictReader', return_value=mock_reader):
+        with unittest.mock.patch('csv.reader', return_value=mock_reader):
             schema = {'columns': {}, 'primaryKey': None}
             
             ingest_certificates(mock_client, 'test.csv', schema, 'existing-index')
@@ -258,50 +392,112 @@ class TestIngestCertificates:
             # Verify index creation was not called
             mock_client.indices.exists.assert_called_once_with(index='existing-index')
             mock_client.indices.create.assert_not_called()
+            # Settings of an index we didn't create are left alone
+            mock_client.indices.put_settings.assert_not_called()
+    
+    @unittest.mock.patch('ingest.helpers')
+    @unittest.mock.patch('builtins.open')
+    def test_ingest_certificates_recreate(self, mock_open, mock_helpers):
+        """Test that recreate=True deletes an existing index and creates it again."""
+        mock_client = unittest.mock.MagicMock()
+        mock_client.indices.exists.return_value = True
+        
+        mock_reader = unittest.mock.MagicMock()
+        mock_reader.__iter__ = unittest.mock.MagicMock(return_value=iter([]))
+        
+        with unittest.mock.patch('csv.reader', return_value=mock_reader):
+            schema = {'columns': {'POSTCODE': 'string'}, 'primaryKey': None}
+            
+            ingest_certificates(mock_client, 'test.csv', schema, 'existing-index', recreate=True)
+            
+            mock_client.indices.delete.assert_called_once_with(index='existing-index')
+            body = mock_client.indices.create.call_args[1]['body']
+            assert 'postcode_normalizer' in body['settings']['analysis']['normalizer']
+            # The recreated index was loaded with bulk settings, so they are restored
+            mock_client.indices.put_settings.assert_called_once()
+    
+    @unittest.mock.patch('ingest.helpers')
+    @unittest.mock.patch('builtins.open')
+    def test_ingest_certificates_restores_settings_on_failure(self, mock_open, mock_helpers):
+        """Test that a failed load into a new index still restores its settings."""
+        mock_client = unittest.mock.MagicMock()
+        mock_client.indices.exists.return_value = False
+        mock_helpers.parallel_bulk.side_effect = ConnectionError('cluster went away')
+        
+        mock_reader = unittest.mock.MagicMock()
+        mock_reader.__iter__ = unittest.mock.MagicMock(return_value=iter([]))
+        
+        with unittest.mock.patch('csv.reader', return_value=mock_reader):
+            schema = {'columns': {}, 'primaryKey': None}
+            
+            with pytest.raises(ConnectionError):
+                ingest_certificates(mock_client, 'test.csv', schema, 'new-index')
+            
+            restored = mock_client.indices.put_settings.call_args[1]['body']['index']
+            assert restored['refresh_interval'] == '1s'
+            mock_client.indices.forcemerge.assert_not_called()
+
+    @unittest.mock.patch('ingest.helpers')
+    @unittest.mock.patch('builtins.open', new_callable=unittest.mock.mock_open)
+    def test_ingest_certificates_failed_restore_keeps_load_error(self, mock_open, mock_helpers):
+        """Test that a restore failing as well does not hide why the load failed."""
+        mock_client = unittest.mock.MagicMock()
+        mock_client.indices.exists.return_value = False
+        mock_helpers.parallel_bulk.side_effect = ConnectionError('cluster went away')
+        mock_client.indices.refresh.side_effect = TimeoutError('refresh timed out')
+        
+        mock_reader = unittest.mock.MagicMock()
+        mock_reader.__iter__ = unittest.mock.MagicMock(return_value=iter([]))
+        
+        with unittest.mock.patch('csv.reader', return_value=mock_reader):
+            schema = {'columns': {}, 'primaryKey': None}
+            
+            with pytest.raises(ConnectionError, match='cluster went away'):
+                ingest_certificates(mock_client, 'test.csv', schema, 'new-index')
+            
+            mock_client.indices.refresh.assert_called_once()
 
 
 class TestMainFunction:
     """Test the main function and argument parsing."""
     
-    @unittest.mock.patch('ingest_domestic_2023.ingest_certificates')
-    @unittest.mock.patch('ingest_domestic_2023.build_properties_index_from_certificates')
-    @unittest.mock.patch('ingest_domestic_2023.OpenSearch')
-    @unittest.mock.patch('ingest_domestic_2023.load_schema')
-    @unittest.mock.patch('os.path.exists')
-    def test_main_basic_args(self, mock_exists, mock_load_schema, mock_opensearch, 
-                           mock_build_props, mock_ingest):
+    @unittest.mock.patch('ingest.ingest_certificates')
+    @unittest.mock.patch('ingest.OpenSearch')
+    @unittest.mock.patch('ingest.load_schema')
+    def test_main_basic_args(self, mock_load_schema, mock_opensearch, mock_ingest):
         """Test main function with basic arguments."""
-        mock_exists.return_value = True
-        mock_load_schema.return_value = {'columns': {}, 'primaryKey': None}
+        schema = {'columns': {}, 'primaryKey': None}
+        mock_load_schema.return_value = schema
         mock_client = unittest.mock.MagicMock()
         mock_opensearch.return_value = mock_client
         
-        # Test basic run without properties index
         main(['--csv', 'test.csv', '--schema', 'test.json'])
         
         mock_load_schema.assert_called_once()
         mock_opensearch.assert_called_once()
         mock_ingest.assert_called_once()
-        mock_build_props.assert_not_called()
+        args, kwargs = mock_ingest.call_args
+        assert args[0] is mock_client
+        assert args[2] is schema
+        assert args[3] == 'certificates'
+        assert kwargs['recreate'] is False
     
-    @unittest.mock.patch('ingest_domestic_2023.ingest_certificates')
-    @unittest.mock.patch('ingest_domestic_2023.build_properties_index_from_certificates')
-    @unittest.mock.patch('ingest_domestic_2023.OpenSearch')
-    @unittest.mock.patch('ingest_domestic_2023.load_schema')
-    @unittest.mock.patch('os.path.exists')
-    def test_main_with_properties(self, mock_exists, mock_load_schema, mock_opensearch,
-                                mock_build_props, mock_ingest):
-        """Test main function with properties index building."""
-        mock_exists.return_value = True
+    @unittest.mock.patch('ingest.ingest_certificates')
+    @unittest.mock.patch('ingest.OpenSearch')
+    @unittest.mock.patch('ingest.load_schema')
+    def test_main_bulk_options(self, mock_load_schema, mock_opensearch, mock_ingest):
+        """Test that index and bulk tuning options are passed through."""
         mock_load_schema.return_value = {'columns': {}, 'primaryKey': None}
-        mock_client = unittest.mock.MagicMock()
-        mock_opensearch.return_value = mock_client
         
-        # Test with properties index building
-        main(['--csv', 'test.csv', '--schema', 'test.json', '--build-properties'])
+        main(['--csv', 'test.csv', '--schema', 'test.json', '--index', 'certs-v2',
+              '--batch-size', '100', '--threads', '2', '--max-chunk-bytes', '1024',
+              '--replicas', '0', '--recreate'])
         
-        mock_ingest.assert_called_once()
-        mock_build_props.assert_called_once()
+        args, kwargs = mock_ingest.call_args
+        assert args[3] == 'certs-v2'
+        assert kwargs == {'batch_size': 100, 'threads': 2, 'max_chunk_bytes': 1024,
+                          'replicas': 0, 'recreate': True}
+        assert mock_opensearch.call_args[1]['maxsize'] == 4
 
 
 if __name__ == '__main__':